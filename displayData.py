@@ -10,9 +10,32 @@ import bokeh.layouts
 import bokeh.models
 import bokeh.plotting
 import bokeh.io
-import datetime
+import concurrent.futures
+import functools
+import itertools
+import numpy
 import os
+import pandas
 import sqlite3
+import sys
+import threading
+
+# Numba is optional. With it, the cost basis kernel compiles to native code;
+# without it, the same function runs as interpreted Python
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        def decorator(function):
+            return function
+        return decorator
+
+
+#############################
+## Import Custom Libraries ##
+#############################
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib'))
+import utility
 
 
 ######################
@@ -27,14 +50,200 @@ DESCRIPTION = 4
 X = 0
 Y = 1
 
+# Cap on how many points per series get shipped to the browser; more than
+# this isn't visually distinguishable on a 1000px-wide plot
+MAX_PLOT_POINTS = 2000
+
+# Each thread gets its own long-lived DB connection (see get_connection)
+thread_local = threading.local()
+
+# The SQL text lives in module constants so every execution of a query is
+# byte-for-byte identical and hits sqlite3's per-connection statement cache
+# instead of being re-parsed
+Q_TICKER_IDS = "SELECT Ticker, Id FROM Tickers;"
+Q_FINGERPRINT = ("SELECT MAX(Date), COUNT(*) "
+                 "FROM Transactions "
+                 "WHERE AccountId = ? AND TickerId = ?;")
+Q_TRANS = ("SELECT Total, Date, Quantity, Price, Description "
+           "FROM Transactions "
+           "WHERE AccountId = ? AND TickerId = ? "
+           "ORDER BY Date ASC;")
+Q_PRICES = ("SELECT * "
+            "FROM Prices "
+            "WHERE TickerId = ? AND Date > (? - 86400)"
+            "ORDER BY Date ASC;")
+Q_ALL_TRANS = ("SELECT TickerId, Total, Date, Quantity, Price, Description "
+               "FROM Transactions "
+               "WHERE AccountId = ? "
+               "  AND TickerId != (SELECT Id FROM Tickers WHERE Ticker = '$CASH$') "
+               "ORDER BY TickerId, Date ASC;")
+Q_ALL_PRICES = ("SELECT * "
+                "FROM Prices "
+                "WHERE TickerId IN (SELECT DISTINCT TickerId FROM Transactions "
+                "                   WHERE AccountId = ?) "
+                "ORDER BY TickerId, Date ASC;")
+Q_ACCOUNT_TICKERS = ("SELECT DISTINCT Ticker "
+                     "FROM Tickers "
+                     "JOIN Transactions ON Transactions.TickerId = Tickers.Id "
+                     "WHERE Transactions.AccountId = ? "
+                     "  AND Ticker != '$CASH$';")
+
+# Cumulative shares held and dividends earned per ticker after each
+# transaction, then join each price day to the most recent transaction
+# state and sum across tickers. The DISTINCT collapses same-day
+# transactions, which carry identical cumulative values. 82740 shifts
+# the cutoff to 11:59 PM so same-day transactions count for that day
+Q_TOTAL_BASIS = ("WITH TransCum AS (SELECT DISTINCT TickerId, Date, "
+                 "    SUM(CASE WHEN Quantity = 0 THEN 0 "
+                 "             WHEN Total > 0 THEN -Quantity "
+                 "             ELSE Quantity END) "
+                 "        OVER (PARTITION BY TickerId ORDER BY Date) AS Shares, "
+                 "    SUM(CASE WHEN Quantity = 0 THEN Total ELSE 0 END) "
+                 "        OVER (PARTITION BY TickerId ORDER BY Date) AS Dividends "
+                 "    FROM Transactions "
+                 "    WHERE AccountId = ? "
+                 "      AND TickerId != (SELECT Id FROM Tickers WHERE Ticker = '$CASH$')) "
+                 "SELECT Prices.Date, SUM(TransCum.Shares * Prices.Close + TransCum.Dividends) "
+                 "FROM Prices "
+                 "JOIN TransCum ON TransCum.TickerId = Prices.TickerId "
+                 "    AND TransCum.Date = (SELECT MAX(Date) FROM TransCum AS Latest "
+                 "                         WHERE Latest.TickerId = Prices.TickerId "
+                 "                           AND Latest.Date < Prices.Date + 82740) "
+                 "GROUP BY Prices.Date "
+                 "ORDER BY Prices.Date ASC;")
+
+# Cached {ticker: id} map and the PRAGMA data_version it was built at
+# (see get_ticker_id_map)
+ticker_id_map = {}
+db_data_version = None
+
 
 ###############
 ## Functions ##
 ###############
+def get_connection():
+    """
+    Purpose: Returns the calling thread's connection to the database, opening
+             and tuning it on first use. sqlite3 connections can't be shared
+             between the worker threads that update() fans the per-ticker
+             work out to, so each thread keeps its own for the app's lifetime
+    @return (Object) - a sqlite DB connection private to the calling thread
+    """
+    if (not hasattr(thread_local, 'con')):
+        thread_local.con = sqlite3.connect("tda.sqlite", cached_statements=256)
+        cursor = thread_local.con.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL;")
+        cursor.execute("PRAGMA synchronous=NORMAL;")
+        cursor.execute("PRAGMA cache_size=-65536;")
+        cursor.execute("PRAGMA mmap_size=268435456;")
+    return thread_local.con
+
+
+def get_ticker_id_map():
+    """
+    Purpose: Returns a cached {ticker: id} map so the hot queries can filter
+             on integer TickerIds without a join or an extra lookup per call.
+             The map is rebuilt only when the database file changed under us,
+             which PRAGMA data_version reports (i.e. importData.py ran)
+    @return (dict) - maps ticker symbols to their integer Tickers.Id
+    """
+    global ticker_id_map, db_data_version
+
+    cursor = get_connection().cursor()
+    version = cursor.execute("PRAGMA data_version;").fetchall()[0][0]
+    if (version != db_data_version or not ticker_id_map):
+        ticker_id_map = dict(cursor.execute(Q_TICKER_IDS).fetchall())
+        db_data_version = version
+
+    return ticker_id_map
+
+
+@njit(cache=True)
+def _compute_basis(day_index, num_trans, trans_total, trans_qty, trans_is_div, trans_is_transfer, price_ts, closes):
+    """
+    Purpose: Numeric kernel for calc_cost_basis. Runs the average-cost
+             recurrence over the transactions using nothing but ndarrays and
+             scalars so Numba can compile it to native code
+    @param day_index (ndarray) - index of the price day each transaction applies to
+    @param num_trans (int) - how many transactions actually apply (prefix of the arrays)
+    @param trans_total (ndarray) - the Total column for each transaction
+    @param trans_qty (ndarray) - the Quantity column for each transaction
+    @param trans_is_div (ndarray) - bools, True for dividend transactions
+    @param trans_is_transfer (ndarray) - bools, True for security transfers
+    @param price_ts (ndarray) - epoch of each price day
+    @param closes (ndarray) - closing price of each price day
+    @return (tuple) - shares and dividends held after each transaction, the
+            x (epoch) and y points of the total-invested series, and the final
+            share count and average cost
+    """
+
+    dividends = 0.0                           # Keep track of the amount of dividends we've earned
+    average_cost = 0.0                        # The average amount we've paid per share of a stock
+    shares = 0.0                              # The number of shares we have
+    shares_after = numpy.zeros(num_trans)     # Shares held after each transaction
+    dividends_after = numpy.zeros(num_trans)  # Dividends earned after each transaction
+
+    # Each transaction produces at most two invested points, so the outputs
+    # can be sized up front and filled through a write cursor
+    invested_x = numpy.empty(2 * num_trans, dtype=numpy.int64)
+    invested_y = numpy.empty(2 * num_trans, dtype=numpy.float64)
+    k = 0
+
+    # Go through each transaction (only the transactions - the per-day series
+    # is built as a single vector operation by the caller)
+    for i in range(num_trans):
+        day = day_index[i]
+
+        # Determine the amount of shares we purchased (positive) or sold (negative)
+        new_shares = trans_qty[i]
+        if (trans_total[i] > 0):
+            new_shares = 0 - new_shares
+
+        # If we had any previous transactions, note that the amount of shares we
+        # previously held is the same as today before the buy or sell
+        if (shares != 0.0):
+            invested_x[k] = price_ts[day]
+            invested_y[k] = average_cost * shares
+            k += 1
+
+        # Update the number of shares, average cost, and dividends
+        if (trans_is_div[i]):  # Dividend transaction
+            dividends += trans_total[i]
+        elif ((shares + new_shares) == 0):  # Sold off a position
+            average_cost = 0.0
+            shares = 0.0
+        elif (trans_is_transfer[i]):  # Option or security transferred from another account
+            # In this situtation, it's impossible to know the true cost basis.
+            # Simply assume the asset was purchased on the day it was transferred
+            if (average_cost == 0.0):
+                average_cost = closes[day]
+            else:
+                average_cost = (average_cost * shares + closes[day]) / (shares + new_shares)
+            shares += new_shares
+        else:  # A typical buy/sell
+            average_cost = (average_cost * shares - trans_total[i]) / (shares + new_shares)
+            shares += new_shares
+
+        # Update the amount we've invested
+        invested_x[k] = price_ts[day]
+        invested_y[k] = average_cost * shares
+        k += 1
+
+        # Record the running state so each price day can look up the most
+        # recent transaction on or before it
+        shares_after[i] = shares
+        dividends_after[i] = dividends
+
+    return (shares_after, dividends_after, invested_x[:k], invested_y[:k], shares, average_cost)
+
+
 def calc_cost_basis(ticker, account):
     """
     Purpose: Retrieves the cost_basis and total invested for a given ticker
-             in an account
+             in an account. Results are memoized: the database only grows
+             between runs of importData.py, so as long as the transaction
+             fingerprint for the (account, ticker) pair is unchanged, the
+             cached series is still valid
     @param ticker (string) - the stock ticker
     @account (string) - the account for which to calculate the cost basis
     @return (tuple) - a tuple containing a list of dates and total account values
@@ -42,98 +251,153 @@ def calc_cost_basis(ticker, account):
             in the given stock
     """
 
-    # Get the data from the database
-    con = sqlite3.connect("tda.sqlite")
-    cursor = con.cursor()
-    trans_data = cursor.execute(("SELECT Total, Date, Quantity, Price, Description "
-                                 "FROM Transactions "
-                                 "JOIN Tickers ON Transactions.TickerId = Tickers.Id "
-                                 "WHERE AccountId = ? AND Ticker = ? "
-                                 "ORDER BY Date ASC;"), [account, ticker]).fetchall()
-    price_data = cursor.execute(("SELECT * " 
-                                 "FROM Prices "
-                                 "JOIN Tickers ON Prices.TickerId = Tickers.Id "
-                                 "WHERE Tickers.Ticker = ? AND Date > (? - 86400)"
-                                 "ORDER BY Date ASC;"), [ticker, trans_data[0][EPOCH]]).fetchall()
-    con.close
+    # The fingerprint invalidates the cache entry whenever transactions are
+    # added for this pair
+    cursor = get_connection().cursor()
+    fingerprint = cursor.execute(Q_FINGERPRINT, [account, get_ticker_id_map()[ticker]]).fetchall()[0]
+    total_invested, cost_basis = _calc_cost_basis_cached(ticker, account, fingerprint)
+
+    # Hand back fresh lists so callers can keep treating the result as mutable
+    return ([list(total_invested[X]), list(total_invested[Y])],
+            [list(cost_basis[X]), list(cost_basis[Y])])
+
+
+@functools.lru_cache(maxsize=512)
+def _calc_cost_basis_cached(ticker, account, fingerprint):
+    """
+    Purpose: Does the actual work for calc_cost_basis. The fingerprint isn't
+             used directly - it's part of the cache key so stale entries miss
+    @param ticker (string) - the stock ticker
+    @param account (string) - the account for which to calculate the cost basis
+    @param fingerprint (tuple) - (max transaction date, transaction count) for the pair
+    @return (tuple) - same shape as calc_cost_basis, but immutable tuples
+    """
+
+    # Get the data from the database. The cached TickerId keeps the two hot
+    # queries below simple indexed range scans rather than joins
+    cursor = get_connection().cursor()
+    ticker_id = get_ticker_id_map()[ticker]
+    trans_data = cursor.execute(Q_TRANS, [account, ticker_id]).fetchall()
+    price_data = cursor.execute(Q_PRICES, [ticker_id, trans_data[0][EPOCH]]).fetchall()
+
+    return _cost_basis_from_rows(trans_data, price_data)
+
+
+def _cost_basis_from_rows(trans_data, price_data):
+    """
+    Purpose: Computes the total invested and cost basis series from already
+             fetched rows, so callers can share one bulk query across tickers
+    @param trans_data (list) - (Total, Date, Quantity, Price, Description) rows
+    @param price_data (list) - Prices rows (Date in column 1, Close in column 3)
+    @return (tuple) - same shape as calc_cost_basis, but immutable tuples
+    """
 
     # Confirm we have price data for all the transaction dates
     assert (price_data[0][EPOCH] < trans_data[0][EPOCH] and trans_data[-1][EPOCH] < (price_data[-1][EPOCH] + 86400)), "Error, price history doesn't cover all transaction dates"
 
-    # Set up variables for the calculations
-    dividends = 0.0            # Keep track of the amount of dividends we've earned
-    average_cost = 0.0         # The average amount we've paid per share of a stock
-    shares = 0.0               # The number of shares we have
-    transaction_index = 0      # Keeps track of what transaction to expect next
-    cost_basis = [[], []]      # List of [[dates] and [prices]]. Each x,y is the liquidation value at a point in time
-    total_invested = [[], []]  # List of [[dates] and [prices]]. Each x,y is the total amount spent at a point in time
-    trans_time = 0             # The time a transaction occurred
-
-    # Go through each day
-    for day in price_data:
-        # Did we have any transactions in the past 24 hours?
-        if (trans_time != -1):
-            trans_time = trans_data[transaction_index][EPOCH]
-        price_time = day[EPOCH] + 82740  # Set the time of day to 11:59 PM rather than 1 AM
-
-        # If so, go through all transactions in the past 24 hours
-        # and adjust the number of shares, average cost, and dividends accordingly
-        while (price_time - trans_time > 0 and trans_time != -1):
-
-            # Determine the amount of shares we purchased (positive) or sold (negative)
-            new_shares = trans_data[transaction_index][QUANTITY]
-            if (trans_data[transaction_index][TOTAL] > 0):
-                new_shares = 0 - new_shares
-
-            # If we had any previous transactions, note that the amount of shares we
-            # previously held is the same as today before the buy or sell
-            if (shares):
-                total_invested[X].append(datetime.datetime.fromtimestamp(day[EPOCH]))
-                total_invested[Y].append(average_cost * shares)
-
-            # Update the number of shares, average cost, and dividends
-            if (new_shares == 0):  # Dividend transaction
-                assert ('DIVIDEND' in trans_data[transaction_index][4]), 'Encountered a transaction without any changes in shares but a change in total'
-                dividends += trans_data[transaction_index][TOTAL]
-            elif ((shares + new_shares) == 0):  # Sold off a position
-                average_cost = 0.0
-                shares = 0
-            elif ('TRANSFER OF SECURITY' in trans_data[transaction_index][DESCRIPTION]):  # Option or security transferred from another account
-                # In this situtation, it's impossible to know the true cost basis.
-                # Simply assume the asset was purchased on the day it was transferred
-                if (average_cost == 0.0):
-                    average_cost = day[CLOSE]
-                else:
-                    average_cost = (average_cost * shares + day[CLOSE]) / (shares + new_shares)
-                shares += new_shares
-            else:  # A typical buy/sell
-                average_cost = (average_cost * shares - trans_data[transaction_index][TOTAL]) / (shares + new_shares)
-                shares += new_shares
-            
-            # Update the amount we've invested
-            total_invested[X].append(datetime.datetime.fromtimestamp(day[EPOCH]))
-            total_invested[Y].append(average_cost * shares)
-
-            # Now look for the next transaction. If there are no more, set the time to -1
-            transaction_index += 1
-            if (transaction_index < len(trans_data)):
-                trans_time = trans_data[transaction_index][EPOCH]
-            else:
-                trans_time = -1
-
-        # Update the current value of our asset
-        if (shares or len(cost_basis[X]) > 0):
-            cost_basis[X].append(datetime.datetime.fromtimestamp(day[EPOCH]))
-            cost_basis[Y].append(shares * day[CLOSE] + dividends)
+    # Transpose the row tuples into one column per field (struct-of-arrays)
+    # in a single pass, so the math below happens on contiguous NumPy arrays
+    # rather than via two Python indexings per field access
+    totals, epochs, quantities, prices, descriptions = zip(*trans_data)
+    trans_ts          = numpy.array(epochs, dtype=numpy.int64)
+    trans_total       = numpy.array(totals, dtype=numpy.float64)
+    trans_qty         = numpy.array(quantities, dtype=numpy.float64)
+    trans_is_div      = (trans_qty == 0)
+    trans_is_transfer = numpy.array(['TRANSFER OF SECURITY' in description for description in descriptions])
+    price_columns     = list(zip(*price_data))
+    price_ts          = numpy.array(price_columns[EPOCH], dtype=numpy.int64)
+    closes            = numpy.array(price_columns[CLOSE], dtype=numpy.float64)
+
+    # A transaction with no change in shares had better be a dividend. This
+    # check involves strings, so it lives outside the compiled kernel
+    for i in numpy.flatnonzero(trans_is_div):
+        assert ('DIVIDEND' in descriptions[i]), 'Encountered a transaction without any changes in shares but a change in total'
+
+    # Map each transaction to the first price day that closes after it.
+    # 82740 sets the time of day to 11:59 PM rather than 1 AM
+    day_index = numpy.searchsorted(price_ts + 82740, trans_ts, side='right')
+
+    # Transactions after the final close never get applied (same behavior as
+    # waiting for the next price day that doesn't exist yet)
+    num_trans = int(numpy.count_nonzero(day_index < len(price_ts)))
+
+    # Run the average-cost recurrence over the transactions in the kernel
+    (shares_after, dividends_after,
+     invested_x, invested_y,
+     shares, average_cost) = _compute_basis(day_index, num_trans, trans_total, trans_qty,
+                                            trans_is_div, trans_is_transfer, price_ts, closes)
+
+    # For every price day, find the last transaction applied on or before it,
+    # then compute the liquidation value of the whole series in one vector op
+    last_trans = numpy.searchsorted(day_index[:num_trans], numpy.arange(len(price_ts)), side='right') - 1
+    shares_per_day = numpy.where(last_trans >= 0, shares_after[last_trans], 0.0)
+    dividends_per_day = numpy.where(last_trans >= 0, dividends_after[last_trans], 0.0)
+
+    # The graph starts on the first day we actually held shares
+    held_days = numpy.flatnonzero(shares_per_day)
+    if (len(held_days) > 0):
+        start = held_days[0]
+        cost_x = price_ts[start:]
+        cost_y = shares_per_day[start:] * closes[start:] + dividends_per_day[start:]
+    else:
+        cost_x = numpy.empty(0, dtype=numpy.int64)
+        cost_y = numpy.empty(0, dtype=numpy.float64)
 
     # Extend the amount invested all the way to the end of the graph
-    if (price_data):
-        total_invested[X].append(datetime.datetime.fromtimestamp(price_data[-1][EPOCH]))
-        total_invested[Y].append(average_cost * shares)
+    invested_x = numpy.append(invested_x, price_ts[-1])
+    invested_y = numpy.append(invested_y, average_cost * shares)
+
+    # Convert the epochs to datetimes in a single C-level pass rather than
+    # one fromtimestamp call per point. Tuples keep the cached value immutable
+    total_invested = (tuple(pandas.to_datetime(invested_x, unit='s')), tuple(invested_y))
+    cost_basis = (tuple(pandas.to_datetime(cost_x, unit='s')), tuple(cost_y))
 
     return (total_invested, cost_basis)
 
 
+def calc_total_basis(account):
+    """
+    Purpose: Calculates the combined liquidation value of every ticker in an
+             account with a single SQL window-function query rather than
+             merging per-ticker results in Python
+    @param account (string) - the account for which to calculate the value
+    @return (list) - a list of [[dates], [values]]. Each x,y is the combined
+            liquidation value of the account's positions at a point in time
+    """
+
+    cursor = get_connection().cursor()
+    basis_data = cursor.execute(Q_TOTAL_BASIS, [account]).fetchall()
+
+    return [list(pandas.to_datetime([row[0] for row in basis_data], unit='s')),
+            [row[1] for row in basis_data]]
+
+
+def push_to_source(source, data):
+    """
+    Purpose: Sends new data to a ColumnDataSource. When the columns already
+             in the source are a prefix of the new ones - the common case of
+             the series only growing at the end after an importData.py run -
+             only the new tail is streamed, so Bokeh serializes and ships
+             just the points the browser doesn't have yet
+    @param source (ColumnDataSource) - the data source backing a glyph
+    @param data (dict) - the new column data to display
+    """
+
+    old = source.data
+    old_length = min((len(column) for column in old.values()), default=0)
+    new_length = min(len(column) for column in data.values())
+
+    # Stream the tail if the data we already sent is an exact prefix
+    if (0 < old_length <= new_length and set(old) == set(data) and
+            all(list(data[name][:old_length]) == list(old[name]) for name in data)):
+        if (old_length < new_length):
+            source.stream({name: column[old_length:] for name, column in data.items()}, rollover=None)
+        return
+
+    # Anything else (account or ticker switch, revised history) is a full redraw
+    source.data = data
+
+
 def ticker_change(attrname, old, new):
     """
     Purpose: Called when a ticker is selected from the dropdown menu.
@@ -155,14 +419,8 @@ def account_change(attrname, old, new):
     account = account_selection.value
 
     # Update the available tickers for that account
-    con = sqlite3.connect("tda.sqlite")
-    cursor = con.cursor()
-    tickers = cursor.execute(("SELECT DISTINCT Ticker "
-                              "FROM Tickers "
-                              "JOIN Transactions ON Transactions.TickerId = Tickers.Id "
-                              "WHERE Transactions.AccountId = ? "
-                              "  AND Ticker != '$CASH$';"), [account]).fetchall()
-    con.close()
+    cursor = get_connection().cursor()
+    tickers = cursor.execute(Q_ACCOUNT_TICKERS, [account]).fetchall()
     assert len(tickers) != 0, "No available tickers in the database for account {0}".format(account)
     tickers = [ticker[0] for ticker in tickers]
     tickers.append('Total')
@@ -188,93 +446,124 @@ def update():
     # Calculate the cost basis
     if (ticker == 'Total'):
 
-        # Get all the data from all tickers
-        total_invested_dict = {}
-        cost_basis_dict = {}
-        for t in tickers:
-
-            # Ignore the fake ticker
-            if (t == 'Total'):
-                continue
-
-            total_invested, cost_basis = calc_cost_basis(t, account)
-
-            # For the ticker, note the date and by how much we invested
-            # on that date
-            running_total = 0
-            for i in range(0, len(total_invested[X])):
-                if (total_invested[Y][i] != running_total):
-                    if (total_invested[X][i] in total_invested_dict.keys()):
-                        total_invested_dict[total_invested[X][i]] += (total_invested[Y][i] - running_total)
-                    else:
-                        total_invested_dict[total_invested[X][i]] = (total_invested[Y][i] - running_total)
-                    running_total = total_invested[Y][i]
-
-            # For the ticker, note each date and the value of our investment at that time
-            for i in range(0, len(cost_basis[X])):
-                if (cost_basis[X][i] in cost_basis_dict.keys()):
-                    cost_basis_dict[cost_basis[X][i]] += cost_basis[Y][i]
-                else:
-                    cost_basis_dict[cost_basis[X][i]] = cost_basis[Y][i]
-
-        # For each date in the dictionary, sort the dates and
-        # note the price at each date
-        total_invested = [[], []]
-        total_invested_temp = list(total_invested_dict.keys())
-        total_invested_temp.sort()
-        running_total = 0
-        for date in total_invested_temp:
-            # Extend the graph line to the next increase in
-            # total invested
-            if (running_total):
-                total_invested[X].append(date)
-                total_invested[Y].append(total_invested[Y][-1])
-            running_total += total_invested_dict[date]
-            total_invested[X].append(date)
-            total_invested[Y].append(running_total)
-
-        # For each date in the dictionary, sort the dates and
-        # note the price at each date
-        cost_basis = [[], []]
-        cost_basis_temp = list(cost_basis_dict.keys())
-        cost_basis_temp.sort()
-        for date in cost_basis_temp:
-            cost_basis[X].append(date)
-            cost_basis[Y].append(cost_basis_dict[date])
+        # The combined value of the account is a single SQL query. The amount
+        # invested still needs the per-ticker average-cost recurrence, which
+        # doesn't reduce to a window sum, so that stays in Python below
+        cost_basis = calc_total_basis(account)
+
+        # Get the amount invested from all tickers. Two bulk queries fetch
+        # every ticker's rows for the account at once, and the result is
+        # split by TickerId client-side - instead of two queries per ticker
+        cursor = get_connection().cursor()
+        trans_rows = cursor.execute(Q_ALL_TRANS, [account]).fetchall()
+        price_rows = cursor.execute(Q_ALL_PRICES, [account]).fetchall()
+        trans_by_ticker = {ticker_id: [row[1:] for row in rows]
+                           for ticker_id, rows in itertools.groupby(trans_rows, key=lambda row: row[0])}
+        prices_by_ticker = {ticker_id: list(rows)
+                            for ticker_id, rows in itertools.groupby(price_rows, key=lambda row: row[0])}
+
+        def basis_for_ticker(ticker_id):
+            trans_data = trans_by_ticker[ticker_id]
+            # Same price window the per-ticker query applies
+            cutoff = trans_data[0][EPOCH] - 86400
+            price_data = [row for row in prices_by_ticker[ticker_id] if row[1] > cutoff]
+            return _cost_basis_from_rows(trans_data, price_data)
+
+        # The per-ticker computation is still fanned out to a thread pool
+        ticker_ids = [ticker_id for ticker_id in trans_by_ticker if ticker_id in prices_by_ticker]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(ticker_ids), os.cpu_count())) as executor:
+            results = executor.map(basis_for_ticker, ticker_ids)
+
+        # Align every ticker's invested series onto one canonical timeline.
+        # Invested points always land on price days, so the distinct price
+        # dates from the bulk fetch above serve as the shared index - no
+        # extra query needed. Sampling each ticker's step function onto it
+        # is one searchsorted, and summing across tickers is one reduction
+        # over the resulting (days x tickers) matrix
+        canonical = numpy.unique(numpy.array([row[1] for row in price_rows], dtype='datetime64[s]')).astype('datetime64[ns]')
+        invested_matrix = numpy.zeros((len(canonical), len(ticker_ids)))
+        for column, (total_invested, _) in enumerate(results):
+            ticker_x = numpy.array(total_invested[X], dtype='datetime64[ns]')
+            ticker_y = numpy.array(total_invested[Y], dtype=numpy.float64)
+            index = numpy.searchsorted(ticker_x, canonical, side='right') - 1
+            invested_matrix[:, column] = numpy.where(index >= 0, ticker_y[index], 0.0)
+        invested_totals = invested_matrix.sum(axis=1)
+
+        # The graph starts with the first dollar invested and only keeps the
+        # dates where the total changes
+        held = numpy.flatnonzero(invested_totals)
+        start = held[0] if (len(held) > 0) else 0
+        invested_totals = invested_totals[start:]
+        canonical = canonical[start:]
+        change = numpy.empty(len(invested_totals), dtype=bool)
+        change[0] = True
+        change[1:] = (invested_totals[1:] != invested_totals[:-1])
+        dates = canonical[change]
+        values = invested_totals[change]
+
+        # Add the vertical step points the line glyph needs by interleaving
+        # each date's previous value with its own into pre-sized arrays -
+        # no per-point list.append. The leading horizontal segment is
+        # dropped where the previous value was zero, as before
+        previous = numpy.roll(values, 1)
+        previous[0] = 0
+        keep = numpy.empty(2 * len(dates), dtype=bool)
+        keep[0::2] = (previous != 0)
+        keep[1::2] = True
+        step_x = numpy.repeat(dates, 2)[keep]
+        step_y = numpy.stack([previous, values], axis=1).ravel()[keep]
+        total_invested = [list(pandas.to_datetime(step_x)), list(step_y)]
 
         # Extend the total invested to the end of the graph
         total_invested[X].append(cost_basis[X][-1])
-        total_invested[Y].append(running_total)
+        total_invested[Y].append(total_invested[Y][-1])
 
     else:
         total_invested, cost_basis = calc_cost_basis(ticker, account)
 
-    # Calculate % gain/loss and $ gain/loss for the hover tool
-    daily_invested = []
-    cost_basis_dollar = []
-    cost_basis_percent = []
-    invested_index = 0
-    invested_max_index = len(total_invested[X]) - 1
-    for i in range(0, len(cost_basis[X])):
-        while (invested_index < invested_max_index - 1 and
-               total_invested[X][invested_index+1] <= cost_basis[X][i]):
-            invested_index += 1
-        daily_invested.append(total_invested[Y][invested_index])  # Record the amount we have invested on this date
-        if (daily_invested[-1] != 0):  # Avoid divide by zero when position is sold off completely
-            cost_basis_dollar.append(cost_basis[Y][i] - daily_invested[-1])  # Record the cost basis on this date
-            cost_basis_percent.append((cost_basis_dollar[-1] * 100) / daily_invested[-1]) 
-        else:
-            cost_basis_dollar.append(0)
-            cost_basis_percent.append(0)
-    
-    # Set the data for the graph
-    invested_source.data = { 'x_axis': total_invested[X],
-                             'y_axis': total_invested[Y] }
-    basis_source.data = { 'x_axis':        cost_basis[X],
-                          'y_axis':        cost_basis[Y],
-                          'invested':      daily_invested,
-                          'basis_dollar':  cost_basis_dollar,
-                          'basis_percent': cost_basis_percent }
+    # Calculate % gain/loss and $ gain/loss for the hover tool. Each cost
+    # basis date is matched to the latest invested amount on or before it
+    # with one searchsorted instead of a per-row index walk
+    invested_x = numpy.array(total_invested[X], dtype='datetime64[ns]')
+    invested_y = numpy.array(total_invested[Y], dtype=numpy.float64)
+    basis_y = numpy.array(cost_basis[Y], dtype=numpy.float64)
+    invested_index = numpy.searchsorted(invested_x, numpy.array(cost_basis[X], dtype='datetime64[ns]'), side='right') - 1
+    invested_index = numpy.clip(invested_index, 0, max(len(invested_x) - 2, 0))
+    daily_invested = invested_y[invested_index]  # The amount we have invested on each date
+
+    # Avoid divide by zero when a position is sold off completely
+    cost_basis_dollar = numpy.where(daily_invested != 0, basis_y - daily_invested, 0.0)
+    cost_basis_percent = numpy.divide(cost_basis_dollar * 100, daily_invested,
+                                      out=numpy.zeros_like(cost_basis_dollar),
+                                      where=(daily_invested != 0))
+    daily_invested = daily_invested.tolist()
+    cost_basis_dollar = cost_basis_dollar.tolist()
+    cost_basis_percent = cost_basis_percent.tolist()
+
+
+    # Downsample long histories before they ever reach the browser. The
+    # selection indices also subset the hover columns so the tooltips stay
+    # aligned with the plotted points
+    if (len(cost_basis[X]) > MAX_PLOT_POINTS):
+        keep = utility.lttb_downsample(numpy.array(cost_basis[X], dtype='datetime64[ns]').astype(numpy.float64),
+                                       basis_y, MAX_PLOT_POINTS)
+        cost_basis = [[cost_basis[X][i] for i in keep], [cost_basis[Y][i] for i in keep]]
+        daily_invested = [daily_invested[i] for i in keep]
+        cost_basis_dollar = [cost_basis_dollar[i] for i in keep]
+        cost_basis_percent = [cost_basis_percent[i] for i in keep]
+    if (len(total_invested[X]) > MAX_PLOT_POINTS):
+        keep = utility.lttb_downsample(numpy.array(total_invested[X], dtype='datetime64[ns]').astype(numpy.float64),
+                                       numpy.array(total_invested[Y], dtype=numpy.float64), MAX_PLOT_POINTS)
+        total_invested = [[total_invested[X][i] for i in keep], [total_invested[Y][i] for i in keep]]
+
+    # Set the data for the graph, streaming just the new points where possible
+    push_to_source(invested_source, { 'x_axis': total_invested[X],
+                                      'y_axis': total_invested[Y] })
+    push_to_source(basis_source, { 'x_axis':        cost_basis[X],
+                                   'y_axis':        cost_basis[Y],
+                                   'invested':      daily_invested,
+                                   'basis_dollar':  cost_basis_dollar,
+                                   'basis_percent': cost_basis_percent })
 
     # Color the cost basis line based on performance
     if (total_invested[Y][-1] > cost_basis[Y][-1]):
@@ -291,26 +580,30 @@ def update():
 ### Get the data from the database
 #
 assert (os.path.exists("tda.sqlite")), "Error, tda.sqlite doesn't exist! Have you run importData.py?"
-con = sqlite3.connect("tda.sqlite")
+
+# One connection per thread for the lifetime of the app. Reconnecting on
+# every widget callback costs a file open plus schema parse per click
+con = get_connection()
 cursor = con.cursor()
 
+# Make sure the access paths used by every callback are indexed so the
+# lookups stay logarithmic as the tables grow
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_trans_acct_tkr_date ON Transactions(AccountId, TickerId, Date);")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_prices_tkr_date ON Prices(TickerId, Date);")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_tickers_ticker ON Tickers(Ticker);")
+con.commit()
+
 # Get the list of accounts from the database
 accounts = cursor.execute("SELECT AccountId FROM Accounts;").fetchall()
 assert len(accounts) != 0, "No available accounts in the database"
 accounts = [str(account[0]) for account in accounts]
 
 # Get the list of tickers for the given account from the database
-tickers = cursor.execute(("SELECT DISTINCT Ticker "
-                          "FROM Tickers "
-                          "JOIN Transactions ON Transactions.TickerId = Tickers.Id "
-                          "WHERE Transactions.AccountId = ? "
-                          "  AND Ticker != '$CASH$';"), [accounts[0]]).fetchall()
+tickers = cursor.execute(Q_ACCOUNT_TICKERS, [accounts[0]]).fetchall()
 assert len(tickers) != 0, "No available tickers in the database for account {0}".format(accounts[0])
 tickers = [ticker[0] for ticker in tickers]
 tickers.append('Total')
 
-con.close()
-
 
 #
 ### Set up the graphs
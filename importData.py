@@ -6,6 +6,7 @@
 #############
 ## Imports ##
 #############
+import concurrent.futures
 import configparser
 import datetime
 import gzip
@@ -13,9 +14,8 @@ import json
 import logging
 import logging.handlers
 import os
-import sqlite3
+import shutil
 import sys
-import tda
 import time
 
 
@@ -32,20 +32,22 @@ db_name     = os.path.join(script_dir, 'tda.sqlite')
 #############################
 ## Import Custom Libraries ##
 #############################
+# The lib directory goes on the path here, but the custom libraries (and the
+# heavy tda package they drag in) are imported inside main() so just loading
+# this module stays cheap
 sys.path.append(os.path.join(script_dir, 'lib'))
-import telegram
-import tda_db
-import tda_wrapper
-import utility
 
 
 ###############
 ## Functions ##
 ###############
 def rotator(source, dest):
+    # Stream the log through gzip in 64KiB chunks rather than reading the
+    # whole file into memory. Compression level 6 is much faster than the
+    # default of 9 for barely bigger files
     with open(source, 'rb') as source_file:
-        with gzip.open(dest, 'wb') as zipped_file:
-            zipped_file.write(source_file.read())
+        with gzip.open(dest, 'wb', compresslevel=6) as zipped_file:
+            shutil.copyfileobj(source_file, zipped_file, length=1 << 16)
     os.remove(source)
 
 
@@ -91,6 +93,13 @@ def main():
     logger.setLevel(logging.DEBUG)
     logger.addHandler(handler)
 
+    # Import the custom libraries now that logging is up. Deferring these
+    # keeps the heavy tda import off the early-exit error paths
+    import telegram
+    import tda_db
+    import tda_wrapper
+    import utility
+
     # Read config file
     config = configparser.ConfigParser()
     config.read(os.path.join(script_dir, 'config.ini'))
@@ -109,31 +118,82 @@ def main():
     # Connect to the database
     try:
         logging.debug("Connecting to the sqlite database (filename '{0}')".format(db_name))
-        con    = sqlite3.connect(db_name)
+        con    = tda_db.get_connection(db_name)
         cursor = con.cursor()
     except Exception as e:
         catch_error(tel, e, "Unable to connect to the sqlite db file. Error: {0}".format(repr(e)))
 
-    # If the database is empty, create the tables
+    # If the database is empty, create the tables. Reading sqlite_master on
+    # a healthy connection can't fail, so only the creation itself is guarded
+    cursor.execute("SELECT 1 FROM SQLite_master LIMIT 1;")
+    if (cursor.fetchone() is None):
+        try:
+            logger.warning("Database appears empty. Creating it...")
+            tda_db.create_database(con, cursor)
+        except Exception as e:
+            catch_error(tel, e, "Unable to create the database. Error: {0}".format(repr(e)))
+
+    # Make sure databases created before an index existed pick it up
+    tda_db.ensure_indexes(con, cursor)
+
+    # Load the full symbol -> ticker ID map up front so the per-position
+    # loop below doesn't need a SELECT for every row it touches
+    cursor.execute("SELECT Id, Ticker FROM Tickers;")
+    ticker_map = {symbol: ticker_id for (ticker_id, symbol) in cursor.fetchall()}
+
+    # Keep track of the tickers touched by new transactions and our current
+    # positions so we can update the price history
+    transaction_tickers = set()
+    position_symbols = set()
+
+    # Fetch every account's positions and transactions from TD in parallel
+    # before touching the database. The API calls dominate the wall time and
+    # are network-bound, so threads overlap the round trips. All of the
+    # SQLite writes stay on this thread
     try:
-        cursor.execute("SELECT * FROM SQLite_master;")
-        if (not cursor.fetchall()):
-            try:
-                logger.warning("Database appears empty. Creating it...")
-                tda_db.create_database(con, cursor)
-            except Exception as e:
-                catch_error(tel, e, "Unable to create the database. Error: {0}".format(repr(e)))
+        accounts = td.get_accounts()
+
+        # Find every account's last recorded transaction in one grouped
+        # query so we only ask TD for transactions made since then (or the
+        # account's lifetime if the account has no transactions yet)
+        cursor.execute("SELECT AccountId, MAX(Date) "
+                       "FROM Transactions "
+                       "GROUP BY AccountId;")
+        last_trans_dates = dict(cursor.fetchall())
+
+        transaction_dates = {}
+        for account in accounts:
+            last_trans_date = last_trans_dates.get(account['account_id'])
+            if (last_trans_date is not None):
+                start_date = utility.from_epoch(last_trans_date)
+                logger.debug("Getting all transactions in account ID {0} made since {1}".format(account['account_id'], start_date))
+                transaction_dates[account['account_id']] = (start_date, datetime.datetime.now())
+            else:
+                logger.debug("No transactions recorded. Getting all transactions over the lifetime of account ID {0}".format(account['account_id']))
+                transaction_dates[account['account_id']] = (None, None)
+
+        def fetch_account(account):
+            (start_date, end_date) = transaction_dates[account['account_id']]
+            return (td.get_account_positions(account['account_id']),
+                    td.get_transactions(account['account_id'], start_date=start_date, end_date=end_date))
+
+        logger.debug("Fetching positions and transactions for {0} accounts".format(len(accounts)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            account_data = list(executor.map(fetch_account, accounts))
     except Exception as e:
-        catch_error(tel, e, "Unable to look for tables in the database. Error: {0}".format(repr(e)))
+        catch_error(tel, e, "Unable to fetch account data from TD. Error: {0}".format(repr(e)))
 
-    # Keep track of all the transactions we made and our current positions
-    # so we can update the price history
-    transactions = []
-    position_symbols = set()
+    # Do all of the per-account inserts in one transaction rather than paying
+    # for a disk sync on every single INSERT. Each account gets its own
+    # savepoint so one bad account only rolls back that account's work.
+    # IMMEDIATE takes the write lock up front so we queue behind any other
+    # writer now (honoring busy_timeout) instead of failing mid-transaction
+    con.execute("BEGIN IMMEDIATE;")
 
     # Go through each account looking at all the positions
-    for account in td.get_accounts():
+    for (account, (positions, account_transactions)) in zip(accounts, account_data):
         logger.debug("Working on positions held in account ID {0}".format(account['account_id']))
+        cursor.execute("SAVEPOINT account_import;")
 
         # Insert the account if it doesn't exist
         try:
@@ -144,16 +204,12 @@ def main():
         # Record the amount of cash in the account for later
         cash = account['cash_value']
 
-        # Clear the positions table
-        try:
-            tda_db.clear_positions(con, cursor, account['account_id'])
-        except Exception as e:
-            catch_error(tel, e, "Unable to clear the positions table. Error: {0}".format(repr(e)))
-        
         # Iterate through each position in the account adding new
         # transactions and prices to the DB as well as updating our
-        # positions if we bought or sold anything
-        for position in td.get_account_positions(account['account_id']):
+        # positions if we bought or sold anything. The rows are gathered
+        # here and inserted in one executemany below
+        position_rows = []
+        for position in positions:
 
             # Cash in IRA accounts is stored as a position
             if (position['instrument']['assetType'] == 'CASH_EQUIVALENT' and position['instrument']['symbol'] == 'MMDA1'):
@@ -166,96 +222,126 @@ def main():
                 
             logger.debug("Working on symbol {0}".format(position['instrument']['symbol']))
 
-            # Confirm that the ticker exists in the ticker table
-            try:
-                tda_db.insert_ticker(con, cursor, position['instrument']['symbol'])
-            except Exception as e:
-                catch_error(tel, e, "Unable to insert ticker. Error: {0}".format(repr(e)))
-
-            # Insert our position into the database
-            try:
-                tda_db.insert_position(con, cursor, position, account['account_id'])
-            except Exception as e:
-                catch_error(tel, e, "Unable to update position. Error: {0}".format(repr(e)))
-
-
-        # Insert the amount of cash for the account, faking the position dict.
-        # This will, without a doubt, be a PITA to maintain if we update tda_db.insert_position.
-        # Assumes the symbol  '$CASH$' was inserted when the DB was created
+            # Remember the symbol so we can update its price history below.
+            # The API response is already in memory, so there's no need to
+            # read the positions back out of the database afterwards
+            position_symbols.add(position['instrument']['symbol'])
+
+            # Confirm that the ticker exists in the ticker table. The
+            # in-memory map already knows every existing symbol, so only
+            # genuinely new ones touch the database at all
+            if (position['instrument']['symbol'] not in ticker_map):
+                try:
+                    cursor.execute("INSERT INTO Tickers (Ticker) VALUES (?);", [position['instrument']['symbol']])
+                    ticker_map[position['instrument']['symbol']] = cursor.lastrowid
+                except Exception as e:
+                    catch_error(tel, e, "Unable to insert ticker. Error: {0}".format(repr(e)))
+
+            # Queue our position for insertion into the database
+            assert position['longQuantity'] != 0.0, "We have a non-long position. The DB might not be set up to handle this"
+            position_rows.append((account['account_id'],
+                                  ticker_map[position['instrument']['symbol']],
+                                  position['instrument']['assetType'],
+                                  position['averagePrice'],
+                                  position['longQuantity']))
+
+        # Add the amount of cash for the account as a fake position.
+        # Assumes the symbol '$CASH$' was inserted when the DB was created
+        position_rows.append((account['account_id'], ticker_map['$CASH$'], 'CASH', 1.0, cash))
+
+        # Upsert all of the account's positions with one statement, then
+        # drop whatever we no longer hold. Unlike the old clear-and-reinsert
+        # this leaves unchanged rows untouched instead of rewriting them all
         try:
-            position = { 'longQuantity': cash,
-                         'averagePrice': 1.0,
-                         'instrument': { 'assetType': 'CASH',
-                                         'symbol':    '$CASH$' } }
-            tda_db.insert_position(con, cursor, position, account['account_id'])
+            cursor.executemany("INSERT INTO Positions (AccountId, TickerId, Instrument, Cost, Quantity) "
+                               "VALUES (?, ?, ?, ?, ?) "
+                               "ON CONFLICT (AccountId, TickerId) DO UPDATE SET "
+                               "Instrument = excluded.Instrument, Cost = excluded.Cost, Quantity = excluded.Quantity;",
+                               position_rows)
+            held_tickers = [row[1] for row in position_rows]
+            cursor.execute("DELETE FROM Positions WHERE AccountId = ? AND TickerId NOT IN ({0});".format(
+                               ",".join("?" * len(held_tickers))),
+                           [account['account_id']] + held_tickers)
         except Exception as e:
-            catch_error(tel, e, "Unable to update cash values. Error: {0}".format(repr(e)))
-
-        # Get all the symbols of our current positions. We'll
-        # use this to update the price history for each symbol below
-        position_symbols = position_symbols | {position[1] for position in tda_db.get_positions(con, cursor, account_id=[account['account_id']])}
+            catch_error(tel, e, "Unable to update positions. Error: {0}".format(repr(e)))
 
         # Record any transactions that took place in the account since
         # the last transaction if any positions were updated
         try:
             logger.debug("Updating the transactions table")
-            cursor.execute("SELECT Date "
-                           "FROM Transactions "
-                           "WHERE AccountId = ? "
-                           "ORDER BY Date DESC "
-                           "LIMIT 1", [account['account_id']])
-            last_trans_date = cursor.fetchall()
-
-            # Get either all the transactions in the account since the last transaction
-            # or all the transactions in the account over the lifetime of the account if Transactions table is empty
-            if (len(last_trans_date) == 1):
-                start_date = utility.from_epoch(last_trans_date[0][0])
-                end_date   = datetime.datetime.now()
-                logger.debug("Getting all transactions made since {0}".format(start_date))
-            else:
-                start_date = None
-                end_date   = None
-                logger.debug("Transactions table is empty. Getting all transactions over the lifetime of the account")
-
-            # Update the transactions in the database
-            transactions += tda_db.insert_transactions(con, cursor, td, account['account_id'], start_date=start_date, end_date=end_date)
-
+            transaction_tickers |= tda_db.insert_transactions(con, cursor, td, account['account_id'], transactions=account_transactions)
         except Exception as e:
+            cursor.execute("ROLLBACK TO account_import;")
             catch_error(tel, e, "Unable to update account transactions. Error: {0}".format(repr(e)))
 
+        cursor.execute("RELEASE account_import;")
 
-    # Update the price history for all symbols in the transactions
-    # except our current positions. We want to handle those a bit differently
+    # Commit all of the accounts' inserts at once
+    con.commit()
+
+    # Figure out the price history date range for every symbol we need to
+    # update: all symbols in the recent transactions (only up to their last
+    # transaction date, since we no longer hold them) plus our current
+    # positions (up to today)
+    price_history_work = []
     try:
-        logger.debug("Updating the price history for all recently imported transactions")
-        for symbol in {tda_db.get_ticker_from_id(con, cursor, transaction[2]) for transaction in transactions}:
-            logger.debug("Updating price history for {0}".format(symbol))
-            if (symbol in position_symbols or symbol == '$CASH$'):
-                logger.debug("Not updating {0} yet as we currently hold a position in it".format(symbol))
-                continue
+        # Resolve all of the recent transactions' ticker IDs to symbols in
+        # one query instead of a SELECT per transaction
+        logger.debug("Finding date ranges for the recently imported transactions")
+        recent_symbols = set()
+        if (transaction_tickers):
+            ticker_ids = tuple(transaction_tickers)
+            cursor.execute("SELECT DISTINCT Ticker FROM Tickers "
+                           "WHERE Id IN (?" + ((len(ticker_ids)-1) * ", ?") + ");", ticker_ids)
+            recent_symbols = {row[0] for row in cursor.fetchall()}
+
+        # Look up the last transaction date for every symbol in one grouped
+        # query rather than a SELECT per symbol inside the loop
+        cursor.execute("SELECT Tickers.Ticker, MAX(Transactions.Date) "
+                       "FROM Transactions "
+                       "JOIN Tickers on Transactions.TickerId = Tickers.Id "
+                       "GROUP BY Tickers.Ticker;")
+        last_trans_by_symbol = dict(cursor.fetchall())
+
+        # Skip symbols we currently hold (those are handled below with an
+        # open-ended date range) and the fake cash symbol in one set
+        # difference instead of a membership test per iteration
+        for symbol in (recent_symbols - position_symbols - {'$CASH$'}):
 
             # Set the end date to the date of the last transaction
             # since we don't currently have a position in the given symbol
-            query = ("SELECT Transactions.Date AS Date "
-                     "FROM Transactions "
-                     "JOIN Tickers on Transactions.TickerId = Tickers.Id "
-                     "WHERE Ticker = ? "
-                     "ORDER BY Date DESC "
-                     "LIMIT 1;")
-            cursor.execute(query, [symbol])
-            tda_db.update_price_history(con, cursor, td, symbol=symbol, end_date=utility.from_epoch(cursor.fetchall()[0][0]))
-    except Exception as e:
-        catch_error(tel, e, "Unable to update price history for the recent transactions. Error: {0}".format(repr(e)))
+            end_date   = utility.from_epoch(last_trans_by_symbol[symbol])
+            start_date = tda_db.get_price_history_start(con, cursor, symbol)
+            if (start_date is not None):
+                price_history_work.append((symbol, start_date, end_date))
 
-    # Update the price history for our current positions
-    try:
-        logger.debug("Updating price history for our current positions")
+        logger.debug("Finding date ranges for our current positions")
         for symbol in position_symbols:
             if (symbol == '$CASH$'):  # Ignore the fake symbol we created
                 continue
-            tda_db.update_price_history(con, cursor, td, symbol)
+            start_date = tda_db.get_price_history_start(con, cursor, symbol)
+            if (start_date is not None):
+                price_history_work.append((symbol, start_date, None))
+    except Exception as e:
+        catch_error(tel, e, "Unable to find the price history date ranges. Error: {0}".format(repr(e)))
+
+    # Fetch every symbol's price history from TD in parallel (the calls are
+    # network-bound, so threads overlap the round trips) and insert each
+    # symbol's candles as soon as its fetch finishes, so the DB writes
+    # overlap the remaining network round trips instead of waiting for the
+    # slowest one. All writes stay on this thread and share a single commit
+    try:
+        logger.debug("Fetching price history for {0} symbols".format(len(price_history_work)))
+        con.execute("BEGIN IMMEDIATE;")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            fetches = {executor.submit(td.get_price_history, symbol,
+                                       start_date=start_date, end_date=end_date): symbol
+                       for (symbol, start_date, end_date) in price_history_work}
+            for fetch in concurrent.futures.as_completed(fetches):
+                tda_db.update_price_history(con, cursor, td, fetches[fetch], price_history=fetch.result())
+        con.commit()
     except Exception as e:
-        catch_error(tel, e, "Unable to update price history for our current positions. Error: {0}".format(repr(e)))
+        catch_error(tel, e, "Unable to update the price history. Error: {0}".format(repr(e)))
 
 
     logger.debug("Closing DB connection and exiting")
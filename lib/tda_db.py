@@ -13,6 +13,7 @@ import json
 import os
 import sqlite3
 import sys
+import threading
 
 
 #############################
@@ -23,9 +24,64 @@ import tda_wrapper
 import utility
 
 
+######################
+## Static Variables ##
+######################
+_connections = threading.local()
+
+# In-process {symbol: Id} cache for the Tickers table. Tickers are never
+# deleted or renamed, so a cached Id can't go stale within a run
+_ticker_cache = {}
+
+# logging.getLogger() takes a lock on every call, so grab the logger once
+# at import time instead of at the top of every function
+logger = logging.getLogger(__name__)
+
+
 ###############
 ## Functions ##
 ###############
+def get_connection(db_name):
+    """
+    Purpose: Returns this thread's connection to the given sqlite database,
+             creating and tuning it on first use. sqlite3 connections can't
+             be shared between threads, so each thread gets its own
+    @param db_name (str) - the path to the sqlite database file
+    @return (Object) - sqlite DB connection object
+    """
+
+    con = getattr(_connections, 'con', None)
+    if (con is not None):
+        # The last user may have closed the memoized connection; if so,
+        # fall through and open a fresh one
+        try:
+            con.execute("SELECT 1;")
+            return con
+        except sqlite3.ProgrammingError:
+            pass
+
+    # isolation_level=None turns off the sqlite3 module's implicit
+    # BEGIN-before-DML bookkeeping; the orchestration code (importData,
+    # insert_transactions) opens its transactions explicitly instead
+    con = sqlite3.connect(db_name, isolation_level=None)
+
+    # Rows come back as sqlite3.Row so results can be read by column name
+    # instead of fragile positional indexes (they still unpack like tuples)
+    con.row_factory = sqlite3.Row
+
+    # WAL avoids a full fsync per commit and lets readers run while we
+    # write, and mmap lets reads come straight out of the page cache.
+    # journal_mode is persistent; the rest are per-session
+    con.executescript("PRAGMA journal_mode=WAL;"
+                      "PRAGMA synchronous=NORMAL;"
+                      "PRAGMA busy_timeout=5000;"
+                      "PRAGMA temp_store=MEMORY;"
+                      "PRAGMA mmap_size=268435456;"
+                      "PRAGMA cache_size=-20000;")
+    _connections.con = con
+    return con
+
+
 def get_ticker_id(con, cursor, symbol):
     """
     Purpose: Gets the tickerID from the database for the given symbol
@@ -35,16 +91,20 @@ def get_ticker_id(con, cursor, symbol):
     @return (int or None) - the ID if it exists in the database, None otherwise
     """
 
-    # Set up logging
-    logger = logging.getLogger()
-    logger.debug("Entering get_ticker_id. Parameters are:\n\tsymbol: {0}".format(symbol))
+    logger.debug("Entering get_ticker_id. Parameters are:\n\tsymbol: %s", symbol)
 
-    # Return the ID if it exists, None otherwise
-    query = "SELECT * FROM Tickers WHERE Ticker = ?;"
+    # Check the in-process cache before going to the database
+    if (symbol in _ticker_cache):
+        return _ticker_cache[symbol]
+
+    # Return the ID if it exists, None otherwise. Only the Id column is
+    # selected and only one row is fetched -- no list for a single row
+    query = "SELECT Id FROM Tickers WHERE Ticker = ? LIMIT 1;"
     cursor.execute(query, [symbol])
-    result = cursor.fetchall()
-    if (result):
-        return result[0][0]
+    row = cursor.fetchone()
+    if (row):
+        _ticker_cache[symbol] = row['Id']
+        return row['Id']
     else:
         return None
 
@@ -59,16 +119,14 @@ def get_ticker_from_id(con, cursor, ticker_id):
             or None if it doesn't exist
     """
 
-    # Set up logging
-    logger = logging.getLogger()
-    logger.debug("Entering get_ticker_from_id. Parameters are:\n\tticker_id: {0}".format(ticker_id))
+    logger.debug("Entering get_ticker_from_id. Parameters are:\n\tticker_id: %s", ticker_id)
 
     # Return the ticker symbol if it exists, None otherwise
-    query = "SELECT * FROM Tickers WHERE Id = ?;"
+    query = "SELECT Ticker FROM Tickers WHERE Id = ? LIMIT 1;"
     cursor.execute(query, [ticker_id])
-    result = cursor.fetchall()
-    if (result):
-        return result[0][1]
+    row = cursor.fetchone()
+    if (row):
+        return row['Ticker']
     else:
         return None
 
@@ -81,62 +139,72 @@ def create_database(con, cursor):
     @return (None)
     """
 
-    # Set up logging
-    logger = logging.getLogger()
     logger.debug("Entering create_database")
 
     
-    logger.debug("Creating Tickers table")
-    cursor.execute("CREATE TABLE Tickers (Id INTEGER PRIMARY KEY, "
-                   "Ticker TEXT NOT NULL);")
-    con.commit()
+    # All of the tables and the cash ticker go in one script inside one
+    # transaction, so creating the schema costs a single commit instead of
+    # an fsync per statement
+    logger.debug("Creating the schema")
+    cursor.executescript("""
+        BEGIN;
+        CREATE TABLE Tickers (Id INTEGER PRIMARY KEY,
+                              Ticker TEXT NOT NULL);
+        CREATE TABLE Accounts (AccountId INTEGER PRIMARY KEY,
+                               AccountName TEXT);
+        CREATE TABLE Prices (TickerId INTEGER NOT NULL,
+                             Date INTEGER NOT NULL,
+                             Open REAL NOT NULL,
+                             Close REAL NOT NULL,
+                             High REAL NOT NULL,
+                             Low REAL NOT NULL,
+                             Volume INTEGER NOT NULL,
+                             PRIMARY KEY (TickerId, Date),
+                             FOREIGN KEY (TickerId) REFERENCES Tickers(Id));
+        CREATE TABLE Transactions (Id INTEGER PRIMARY KEY,
+                                   AccountId INTEGER NOT NULL,
+                                   TickerId INTEGER NOT NULL,
+                                   Date INTEGER NOT NULL,
+                                   Quantity REAL NOT NULL,
+                                   Price REAL NOT NULL,
+                                   Total REAL NOT NULL,
+                                   Description TEXT,
+                                   FOREIGN KEY (AccountId) REFERENCES Accounts(AccountId),
+                                   FOREIGN KEY (TickerId) REFERENCES Tickers(Id));
+        CREATE TABLE Positions (AccountId INTEGER NOT NULL,
+                                TickerId INTEGER NOT NULL,
+                                Instrument TEXT NOT NULL,
+                                Cost REAL NOT NULL,
+                                Quantity REAL NOT NULL,
+                                PRIMARY KEY (AccountId, TickerId),
+                                FOREIGN KEY (AccountId) REFERENCES Accounts(AccountId),
+                                FOREIGN KEY (TickerId) REFERENCES Tickers(Id));
+        INSERT INTO Tickers (Ticker) VALUES ('$CASH$');
+        COMMIT;
+        """)
+    ensure_indexes(con, cursor)
 
-    logger.debug("Creating Accounts table")
-    cursor.execute("CREATE TABLE Accounts (AccountId INTEGER PRIMARY KEY, "
-                   "AccountName TEXT);")
-    con.commit()
+    logger.debug("Created database")
+    return None
 
-    logger.debug("Creating Prices table")
-    cursor.execute("CREATE TABLE Prices (TickerId INTEGER NOT NULL, "
-                   "Date INTEGER NOT NULL, "
-                   "Open REAL NOT NULL, "
-                   "Close REAL NOT NULL, "
-                   "High REAL NOT NULL, "
-                   "Low REAL NOT NULL, "
-                   "Volume INTEGER NOT NULL, "
-                   "PRIMARY KEY (TickerId, Date), " 
-                   "FOREIGN KEY (TickerId) REFERENCES Tickers(Id));")
-    con.commit()
-    
-    logger.debug("Creating Transactions table")
-    cursor.execute("CREATE TABLE Transactions (Id INTEGER PRIMARY KEY, "
-                   "AccountId INTEGER NOT NULL, "
-                   "TickerId INTEGER NOT NULL, "
-                   "Date INTEGER NOT NULL, "
-                   "Quantity REAL NOT NULL, "
-                   "Price REAL NOT NULL, "
-                   "Total REAL NOT NULL, "
-                   "Description TEXT, "
-                   "FOREIGN KEY (AccountId) REFERENCES Accounts(AccountId), "
-                   "FOREIGN KEY (TickerId) REFERENCES Tickers(Id));")
-    con.commit()
 
-    logger.debug("Creating Positions table")
-    cursor.execute("CREATE TABLE Positions (AccountId INTEGER NOT NULL, "
-                   "TickerId INTEGER NOT NULL, "
-                   "Instrument TEXT NOT NULL, "
-                   "Cost REAL NOT NULL, "
-                   "Quantity REAL NOT NULL, "
-                   "PRIMARY KEY (AccountId, TickerId), "
-                   "FOREIGN KEY (AccountId) REFERENCES Accounts(AccountId), "
-                   "FOREIGN KEY (TickerId) REFERENCES Tickers(Id)); ")
-    con.commit()
+def ensure_indexes(con, cursor):
+    """
+    Purpose: Creates the indexes the latest/earliest date lookups rely on.
+             Safe to run on every connect, so existing databases created
+             before an index was added pick it up too. Prices needs no
+             index here -- its (TickerId, Date) primary key already covers
+             its date lookups
+    @param con (Object) - sqlite DB connection object
+    @param cursor (Object) - sqlite DB cursor object
+    @return (None)
+    """
 
-    logger.debug("Creating the cash ticker")
-    cursor.execute("INSERT INTO Tickers (Ticker) VALUES ('$CASH$');")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_trans_acct_date ON Transactions (AccountId, Date DESC);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_trans_tkr_date ON Transactions (TickerId, Date);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tickers_ticker ON Tickers (Ticker);")
     con.commit()
 
-    logger.debug("Created database")
     return None
 
 
@@ -150,21 +218,12 @@ def insert_account(con, cursor, account_id):
     @return (None)
     """
     
-    # Set up logging
-    logger = logging.getLogger()
-    logger.debug("Entering insert_account. Parameters are:\n\taccount_id: {0}".format(account_id))
-
-    # Does it exist already?
-    logger.debug("Checking to see if the account exists in the DB")
-    query = "SELECT * FROM Accounts WHERE AccountId = ?;"
-    cursor.execute(query, [account_id])
-    if (not cursor.fetchall()):
-        logger.debug("No results from DB. Inserting account")
-        cursor.execute("INSERT INTO Accounts (AccountId) VALUES (?);", [account_id])
-        con.commit()
-        logger.debug("Account inserted")
-    else:
-        logger.debug("Account already existed")
+    logger.debug("Entering insert_account. Parameters are:\n\taccount_id: %s", account_id)
+
+    # AccountId is the primary key, so INSERT OR IGNORE handles the
+    # existence check in the same statement as the insert
+    cursor.execute("INSERT OR IGNORE INTO Accounts (AccountId) VALUES (?);", [account_id])
+    logger.debug("Account inserted" if cursor.rowcount else "Account already existed")
 
     return None
 
@@ -172,33 +231,60 @@ def insert_account(con, cursor, account_id):
 def insert_ticker(con, cursor, symbol):
     """
     Purpose: Inserts the symbol into the ticker table if it doesn't
-             already exist
+             already exist and returns its Id
     @param con (Object) - sqlite DB connection object
     @param cursor (Object) - sqlite DB cursor object
     @param symbol (str) - the ticker symbol for the stock
-    @return (bool) True if the symbol was inserted, False otherwise
+    @return (int) - the Id of the (possibly pre-existing) ticker
     """
-    
-    # Set up logging
-    logger = logging.getLogger()
-    logger.debug("Entering insert_ticker. Parameters are:\n\tsymbol: {0}".format(symbol))
 
-    # Does it exist already?
-    logger.debug("Checking to see if the symbol exists in the DB")
+    logger.debug("Entering insert_ticker. Parameters are:\n\tsymbol: %s", symbol)
+
+    # Does it exist already? get_ticker_id usually answers from the
+    # in-process cache without touching the database
     ticker_id = get_ticker_id(con, cursor, symbol)
 
-    # If not, add it, otherwise, return
-    if (not ticker_id):
+    # If not, add it. lastrowid gives us the new Id for free, so there's
+    # no follow-up SELECT to find out what we just inserted
+    if (ticker_id is None):
         logger.debug("No results from DB. Inserting symbol")
         cursor.execute("INSERT INTO Tickers (Ticker) VALUES (?);", [symbol])
-        con.commit()
+        ticker_id = cursor.lastrowid
+        _ticker_cache[symbol] = ticker_id
         logger.debug("Symbol inserted")
-        symbol_added = True
     else:
         logger.debug("Symbol already existed")
-        symbol_added = False
 
-    return symbol_added
+    return ticker_id
+
+
+def _to_epoch(date_string):
+    """
+    Purpose: Converts a TD API date string to epoch seconds. The C-level
+             fromisoformat is an order of magnitude faster than dateutil's
+             pure-Python parser, which we keep only as a fallback for any
+             date shape fromisoformat can't handle
+    @param date_string (str) - the date, e.g. '2021-01-02T03:04:05+0000'
+    @return (int) - the epoch time of the date
+    """
+
+    try:
+        return int(datetime.datetime.fromisoformat(date_string.replace('Z', '+00:00')).timestamp())
+    except ValueError:
+        return int(dateutil.parser.parse(date_string).timestamp())
+
+
+def _in_clause(column, values):
+    """
+    Purpose: Builds a parameterized "column IN (?, ?, ...)" fragment with one
+             placeholder per value. Keeping the SQL text identical for equal
+             value counts lets sqlite reuse the prepared statement
+    @param column (str) - the column name to filter on
+    @param values (list) - the values the column should match
+    @return (str) - the SQL fragment
+    """
+
+    return "{0} IN ({1})".format(column, ",".join("?" * len(values)))
 
 
 def get_positions(con, cursor, account_id=None, symbol=None):
@@ -211,9 +297,7 @@ def get_positions(con, cursor, account_id=None, symbol=None):
     @return (list) the positions
     """
 
-    # Set up logging
-    logger = logging.getLogger()
-    logger.debug("Entering get_positions. Parameters are:\n\taccount_id: {0}\n\tsymbol: {1}".format(account_id, symbol))
+    logger.debug("Entering get_positions. Parameters are:\n\taccount_id: %s\n\tsymbol: %s", account_id, symbol)
 
     # Build the query
     query = ("SELECT AccountId, Tickers.Ticker, Instrument, Cost, Quantity "
@@ -222,19 +306,77 @@ def get_positions(con, cursor, account_id=None, symbol=None):
              "WHERE 1=1 ")
     args = []
     if (account_id):
-        query += "AND AccountId IN (?" + ((len(account_id)-1) * ", ?") + ") "
+        query += "AND " + _in_clause("AccountId", account_id) + " "
         args += account_id
     if (symbol):
-        query += "AND Tickers.Ticker IN (?" + ((len(symbol)-1) * ", ?") + ") "
+        query += "AND " + _in_clause("Tickers.Ticker", symbol) + " "
         args += symbol
 
     # Execute the query and return the results
-    logger.debug("Executing query: {0}\nWith args: {1}".format(query, args))
+    logger.debug("Executing query: %s\nWith args: %s", query, args)
     cursor.execute(query, args)
     return cursor.fetchall()
 
 
-def update_price_history(con, cursor, td, symbol, start_date=None, end_date=None):
+def get_price_history_start(con, cursor, symbol):
+    """
+    Purpose: Figures out the first day we need price history for, based on
+             the most recent price point in the DB. If there's no prior
+             history, it's based on the oldest transaction for the symbol
+    @param con (Object) - sqlite DB connection object
+    @param cursor (Object) - sqlite DB cursor object
+    @param symbol (str) - the ticker symbol for the stock
+    @return (datetime or None) - the first day to get price history for, or
+            None if the symbol has no transactions to base a start date on
+    """
+
+    logger.debug("Entering get_price_history_start. Parameters are:\n\tsymbol: %s", symbol)
+
+    # Get the latest price history entry for the stock in our DB
+    logger.debug("Excuting SQLite query")
+    query = ("SELECT Prices.Date AS Date "
+             "FROM Prices "
+             "JOIN Tickers ON Prices.TickerId = Tickers.Id "
+             "WHERE Ticker = ? "
+             "ORDER BY Date DESC "
+             "LIMIT 1;")
+    cursor.execute(query, [symbol])
+    price_history_db = cursor.fetchone()
+
+    # If we have no price history, then set the start date to the
+    # earliest transaction date
+    if (price_history_db is None):
+        logger.debug("No price history. Fetching earliest transaction date")
+        query = ("SELECT Transactions.Date AS Date "
+                 "FROM Transactions "
+                 "JOIN Tickers on Transactions.TickerId = Tickers.Id "
+                 "WHERE Ticker = ? "
+                 "ORDER BY Date ASC "
+                 "LIMIT 1;")
+        cursor.execute(query, [symbol])
+        last_entry_db = cursor.fetchone()
+
+        # In some cases, we don't yet have a transactionId that we've imported so don't import price data yet
+        # Otherwise, get the earliest transaction date
+        if (last_entry_db is None):
+            logger.debug("No transactions for '%s'. Not updating price data yet", symbol)
+            return None
+        last_entry_db = last_entry_db['Date']
+    else:
+        # Start from the last date in the DB; refetching that day is fine
+        # since the insert ignores rows whose (TickerId, Date) already exist
+        last_entry_db = price_history_db['Date']
+    logger.debug("Retrieving prices for %s starting from %s", symbol, utility.from_epoch(last_entry_db))
+
+    # Get all the prices from the API since the latest price data, if it exists
+    if (last_entry_db != 0):
+        return datetime.datetime(*utility.from_epoch(last_entry_db).timetuple()[:3])  # truncates to yyyy-mm-dd
+    # If the start_date is still unset, default to last 30 days
+    else:
+        return datetime.datetime.now() + datetime.timedelta(days=-31)
+
+
+def update_price_history(con, cursor, td, symbol, start_date=None, end_date=None, price_history=None):
     """
     Purpose: Updates the price history for a stock in the sqlite database
     @param con (Object) - sqlite DB connection object
@@ -244,137 +386,111 @@ def update_price_history(con, cursor, td, symbol, start_date=None, end_date=None
     @param start_date (datetime) - the first day to get price history for. If
            unspecified, this is the last 30 days
     @param end_date (datetime) - the last day to get price history for
+    @param price_history (list) - price history already fetched from the TD
+           API, so callers can fetch several symbols in parallel and just use
+           this function for the insert. If unspecified, we call the API here
     @return (None)
     """
 
-    # Set up logging
-    logger = logging.getLogger()
-    logger.debug("Entering update_price_history. Parameters are:\n\tsymbol: {0}\n\tstart_date: {1}\n\tend_date: {2}".format(symbol, start_date, end_date))
-
-    # If no start date is provided, base the start date off of the most recent
-    # price point in the DB. If no prior history, base it off of the oldest
-    # transaction for the given symbol
-    if (start_date == None):
+    logger.debug("Entering update_price_history. Parameters are:\n\tsymbol: %s\n\tstart_date: %s\n\tend_date: %s", symbol, start_date, end_date)
 
-        # Get the latest price history entry for the stock in our DB
-        logger.debug("Excuting SQLite query")
-        query = ("SELECT Prices.Date AS Date "
-                 "FROM Prices "
-                 "JOIN Tickers ON Prices.TickerId = Tickers.Id "
-                 "WHERE Ticker = ? "
-                 "ORDER BY Date DESC "
-                 "LIMIT 1;")
-        cursor.execute(query, [symbol])
-        price_history_db = cursor.fetchall()
-
-        # If we have no price history, then set the start date to the
-        # earliest transaction date
-        if (not price_history_db):
-            logger.debug("No price history. Fetching earliest transaction date")
-            query = ("SELECT Transactions.Date AS Date "
-                     "FROM Transactions "
-                     "JOIN Tickers on Transactions.TickerId = Tickers.Id "
-                     "WHERE Ticker = ? "
-                     "ORDER BY Date ASC "
-                     "LIMIT 1;")
-            cursor.execute(query, [symbol])
-            last_entry_db = cursor.fetchall()
-
-            # In some cases, we don't yet have a transactionId that we've imported so don't import price data yet
-            # Otherwise, get the earliest transaction date
-            if (len(last_entry_db) == 0 or len(last_entry_db[0]) == 0):
-                logger.debug("No transactions for '{0}'. Not updating price data yet".format(symbol))
+    # Get the price history from TD unless the caller already fetched it
+    if (price_history is None):
+        if (start_date is None):
+            start_date = get_price_history_start(con, cursor, symbol)
+            if (start_date is None):
                 return None
-            last_entry_db = last_entry_db[0][0]
-        else:
-            last_entry_db = price_history_db[0][0] + 86400  # the start date should be 1 day after the last in the DB
-        logger.debug("Retrieving prices for {0} starting from {1}".format(symbol, utility.from_epoch(last_entry_db)))
-
-        # Get all the prices from the API since the latest price data, if it exists
-        if (last_entry_db != 0):
-            start_date = datetime.datetime(*utility.from_epoch(last_entry_db).timetuple()[:3])  # truncates to yyyy-mm-dd
-        # If the start_date is still unset, default to last 30 days
-        else:
-            start_date = datetime.datetime.now() + datetime.timedelta(days=-31)
-
-    # Get the price history for the past month from TD
-    price_history_td = td.get_price_history(symbol, start_date=start_date, end_date=end_date)
+        price_history_td = td.get_price_history(symbol, start_date=start_date, end_date=end_date)
+    else:
+        price_history_td = price_history
 
     # Get the ticker ID from the SQL database
     cursor.execute("SELECT Id FROM Tickers WHERE Ticker = ?;", [symbol])
-    ticker_id = cursor.fetchall()
+    ticker_id = cursor.fetchone()
     assert ticker_id, "No ticker ID for symbol {0}".format(symbol)
-    ticker_id = ticker_id[0][0]
-
-    # Gather new price points
-    insertion_data = []
-    for day in price_history_td:
-        date = int(str(day['datetime'])[:-3])  # Truncate the milliseconds off of the time
-        insertion_data.append((ticker_id, date, day['open'], day['close'], day['high'], day['low'], day['volume']))
-    
-    # Bulk insert the new data
-    logger.debug("Inserting new data: {0}".format(insertion_data))
-    insertion = ("INSERT INTO Prices (TickerId, Date, Open, Close, High, Low, Volume)"
+    ticker_id = ticker_id['Id']
+
+    # Gather the new price points as a generator feeding executemany, so no
+    # intermediate list of tuples is built for long histories. Integer
+    # division truncates the milliseconds without a str round-trip
+    insertion_data = ((ticker_id, day['datetime'] // 1000, day['open'], day['close'],
+                       day['high'], day['low'], day['volume'])
+                      for day in price_history_td)
+
+    # Bulk insert the new data. No commit here -- the caller owns the
+    # transaction so every symbol's candles can share one commit
+    logger.debug("Inserting %s new price points for ticker id %s", len(price_history_td), ticker_id)
+    insertion = ("INSERT OR IGNORE INTO Prices (TickerId, Date, Open, Close, High, Low, Volume)"
                  "VALUES (?, ?, ?, ?, ?, ?, ?);")
     cursor.executemany(insertion, insertion_data)
-    con.commit()
 
     logger.debug("Inserted new data")
     return None
 
 
-def insert_position(con, cursor, position, account_id):
+def _transaction_symbol(transaction):
     """
-    Purpose: Records a position we hold in the Positions table
-    @param con (Object) - sqlite DB connection object
-    @param cursor (Object) - sqlite DB cursor object
-    @param position (dict) - the position as returned by the TD Ameritrade API
-    @param account_id (str) - the account to which the position belongs
-    @return (bool) - True if the position was updated, False otherwise
+    Purpose: Determines which ticker symbol a TD transaction belongs to.
+             Deposits and free-balance interest are booked against the
+             internal cash ticker; everything else names an instrument
+    @param transaction (dict) - a single transaction from the TD API
+    @return (str) - the ticker symbol for the transaction
     """
 
-    # Set up logging
-    logger = logging.getLogger()
-    logger.debug("Entering insert_position. Parameters are:\n\tposition: {0}\n\taccount_id: {1}".format(position, account_id))
+    transaction_type = transaction['type']
+    if (transaction_type == 'ELECTRONIC_FUND'):
+        return '$CASH$'
+    elif (transaction_type == 'DIVIDEND_OR_INTEREST'
+            and transaction['description'] == 'FREE BALANCE INTEREST ADJUSTMENT'):
+        return '$CASH$'
+    elif (transaction_type == 'RECEIVE_AND_DELIVER'
+            and transaction['transactionItem']['instrument']['assetType'] == 'CASH_EQUIVALENT'):
+        return '$CASH$'
+    else:
+        return transaction['transactionItem']['instrument']['symbol']
 
-    assert position['longQuantity'] != 0.0, "We have a non-long position. The DB might not be set up to handle this"
 
-    instrument = position['instrument']['assetType']
-    ticker     = position['instrument']['symbol']
-    quantity   = position['longQuantity']
-    cost       = position['averagePrice']
-    ticker_id  = get_ticker_id(con, cursor, ticker)
-    insertion  = ("INSERT INTO Positions (AccountId, TickerId, Instrument, Cost, Quantity) "
-                 "VALUES (?, ?, ?, ?, ?)")
-    cursor.execute(insertion, [account_id, ticker_id, instrument, cost, quantity])
-    con.commit()
+def _row_dividend(transaction, account_id, ticker_id, epoch):
+    """Builds a Transactions row for a DIVIDEND_OR_INTEREST transaction"""
+    return (transaction['transactionId'], account_id, ticker_id, epoch,
+            0, 0, transaction['netAmount'], transaction['description'])
 
-    logger.debug("Done inserting ticker {0}".format(ticker))
-    return None
 
+def _row_fund(transaction, account_id, ticker_id, epoch):
+    """Builds a Transactions row for an ELECTRONIC_FUND transaction"""
+    return (transaction['transactionId'], account_id, ticker_id, epoch,
+            0, 0, transaction['netAmount'], transaction['description'])
 
-def clear_positions(con, cursor, account_id):
-    """
-    Purpose: Deletes all recorded positions for the given account ID
-    @param con (Object) - sqlite DB connection object
-    @param cursor (Object) - sqlite DB cursor object
-    @param account_id (str) - the account id to clear the positions for
-    """
 
-    # Set up logging
-    logger = logging.getLogger()
-    logger.debug("Entering clear_positions. Parameters are:\n\taccount_id: {0}".format(account_id))
+def _row_recv(transaction, account_id, ticker_id, epoch):
+    """Builds a Transactions row for a RECEIVE_AND_DELIVER transaction"""
+    # Money deposit from another account
+    if (transaction['transactionItem']['instrument']['assetType'] == 'CASH_EQUIVALENT'):
+        return (transaction['transactionId'], account_id, ticker_id, epoch,
+                0, 0, transaction['transactionItem']['amount'], transaction['description'])
+    # Security or option from another account
+    else:
+        return (transaction['transactionId'], account_id, ticker_id, epoch,
+                transaction['transactionItem']['amount'], 0.0,
+                transaction['netAmount'], transaction['description'])
 
-    query = ("DELETE "
-             "FROM Positions "
-             "WHERE AccountId = ?;")
-    cursor.execute(query, [account_id])
 
-    logger.debug("Cleared positions")
-    return None
+def _row_trade(transaction, account_id, ticker_id, epoch):
+    """Builds a Transactions row for a TRADE transaction"""
+    return (transaction['transactionId'], account_id, ticker_id, epoch,
+            transaction['transactionItem']['amount'], transaction['transactionItem']['price'],
+            transaction['netAmount'], transaction['description'])
+
+
+# Maps a transaction type to the function that turns it into a Transactions
+# row, replacing an if/elif chain in the insert_transactions row loop
+_ROW_BUILDERS = {'DIVIDEND_OR_INTEREST': _row_dividend,
+                 'ELECTRONIC_FUND':      _row_fund,
+                 'RECEIVE_AND_DELIVER':  _row_recv,
+                 'TRADE':                _row_trade}
 
 
-def insert_transactions(con, cursor, td, account_id, symbol=None, start_date=None, end_date=None):
+def insert_transactions(con, cursor, td, account_id, symbol=None, start_date=None, end_date=None, transactions=None):
     """
     Purpose: Inserts all transactions that took place in the given account
              during the given time period
@@ -384,105 +500,111 @@ def insert_transactions(con, cursor, td, account_id, symbol=None, start_date=Non
     @param account_id (str) - the account id to retrieve the transactions for
     @param start_date (datetime) - retrieve transactions on or after this date and time
     @param end_date (datetime) - retrieve transactions up until this time
-    @return (list) a list of tuples containing the latest transactions
+    @param transactions (list) - transactions already fetched from the TD
+           API, so callers can fetch several accounts in parallel and just
+           use this function for the insert. If unspecified, we call the API
+    @return (set) the ticker ids referenced by the inserted transactions
     """
 
-    # Set up logging
-    logger = logging.getLogger()
-    logger.debug("Entering insert_transaction. Parameters are:\n\taccount_id: {0}\n\tstart_date: {1}\n\tend_date: {2}".format(account_id, start_date, end_date))
+    logger.debug("Entering insert_transaction. Parameters are:\n\taccount_id: %s\n\tstart_date: %s\n\tend_date: %s", account_id, start_date, end_date)
 
     # Transaction type validation
     IGNORED_TRANSACTIONS = ['JOURNAL', 'CASH_RECEIPT']
     KNOWN_TRANSACTIONS   = ['TRADE', 'ELECTRONIC_FUND', 'DIVIDEND_OR_INTEREST', 'RECEIVE_AND_DELIVER']
     KNOWN_ASSET_TYPES    = ['EQUITY', 'CASH_EQUIVALENT']
 
-    # Get the transactions from the TD API
-    transactions = td.get_transactions(account_id, symbol=symbol, start_date=start_date, end_date=end_date)
-
-    # Get a list of transactions from the DB to ensure no duplicates are entered
+    # Get the transactions from the TD API unless the caller already has them
+    if (transactions is None):
+        transactions = td.get_transactions(account_id, symbol=symbol, start_date=start_date, end_date=end_date)
+
+    # If the caller isn't managing a transaction (importData wraps the whole
+    # account loop in one), open our own so the ticker inserts and the final
+    # executemany still share a single commit instead of one fsync each
+    own_transaction = not con.in_transaction
+    if (own_transaction):
+        con.execute("BEGIN;")
+
+    # Preload the ticker cache in one query so the per-row symbol lookups
+    # below never have to leave memory
+    cursor.execute("SELECT Ticker, Id FROM Tickers;")
+    _ticker_cache.update(cursor.fetchall())
+
+    # Get a set of transaction IDs from the DB to ensure no duplicates are
+    # entered. A set makes the per-row membership test below O(1) instead of
+    # a scan of every ID we've ever imported
     query = ("SELECT Id FROM Transactions")
     cursor.execute(query)
-    existing_transactions = [item[0] for item in cursor.fetchall()]
+    existing_transactions = {item['Id'] for item in cursor.fetchall()}
 
-    # Insert each into the database
-    insertion_data = []
-    new_symbols    = []
+    # Insert every symbol this batch references that we've never seen in one
+    # batched statement, so the row loop below never needs ticker SQL. Only
+    # dividend and trade rows can introduce new symbols; the skip conditions
+    # mirror the row loop so duplicates and ignored types add nothing
+    wanted_symbols = set()
     for transaction in transactions:
-
-        if ('transactionId' not in transaction.keys()):
-            logger.warning("Ignored a transaction without a transaction ID. These usually get added by TD later and will be automatically imported")
-            continue
-
-        logger.debug("Working on transactions id {0} of type {1}".format(transaction['transactionId'], transaction['type']))
-        
-        # ... but only after we ignore certain types
-        if (transaction['type'] in IGNORED_TRANSACTIONS):
-            logger.warning("Ignoring transaction id {0} of type {1}".format(transaction['transactionId'], transaction['type']))
-            continue
-
-        # And we validate that we're not inserting a duplicate
-        if (transaction['transactionId'] in existing_transactions):
-            logger.warning("Ignoring transaction id {0} because it already exists in the DB".format(transaction['transactionId']))
+        if ('transactionId' not in transaction
+                or transaction['type'] in IGNORED_TRANSACTIONS
+                or transaction['transactionId'] in existing_transactions):
             continue
-
-        # And we're scared of the unknown
-        assert (transaction['type'] in KNOWN_TRANSACTIONS), "Encountered unknown type of transaction '{0}' in transaction id {1}".format(transaction['type'], transaction['transactionId'])
-        if (transaction['type'] != 'ELECTRONIC_FUND' and transaction['description'] != 'FREE BALANCE INTEREST ADJUSTMENT'):
-            assert (transaction['transactionItem']['instrument']['assetType'] in KNOWN_ASSET_TYPES), "Encountered unknown asset type '{0}' in transaction id {1}".format(transaction['transactionItem']['instrument']['assetType'], transaction['transactionId'])
-
-        # Prepare the transaction(s) for insertion
-
-        # Dividends
-        if (transaction['type'] == 'DIVIDEND_OR_INTEREST'):
-            if (transaction['description'] == 'FREE BALANCE INTEREST ADJUSTMENT'):
-                symbol = '$CASH$'
-            else:
-                symbol = transaction['transactionItem']['instrument']['symbol']
-            # Add the symbol if it doesn't already exist
-            insert_ticker(con, cursor, symbol)
-            insertion_data.append((transaction['transactionId'], account_id, 
-                                   get_ticker_id(con, cursor, symbol),
-                                   int((dateutil.parser.parse(transaction['transactionDate'])).timestamp()),
-                                   0, 0, transaction['netAmount'], transaction['description']))
-
-        # Money deposit
-        elif (transaction['type'] == 'ELECTRONIC_FUND'):
-            insertion_data.append((transaction['transactionId'], account_id,
-                                   get_ticker_id(con, cursor, '$CASH$'),
-                                   int((dateutil.parser.parse(transaction['transactionDate'])).timestamp()),
-                                   0, 0, transaction['netAmount'], transaction['description']))
-
-        # Transfer of securities and options
-        elif (transaction['type'] == 'RECEIVE_AND_DELIVER'):
-            # Money deposit from another account
-            if (transaction['transactionItem']['instrument']['assetType'] == 'CASH_EQUIVALENT'):
-                insertion_data.append((transaction['transactionId'], account_id,
-                                       get_ticker_id(con, cursor, '$CASH$'),
-                                       int((dateutil.parser.parse(transaction['transactionDate'])).timestamp()),
-                                       0, 0, transaction['transactionItem']['amount'], transaction['description']))
-            # Security or option from another account
-            else:
-                insertion_data.append((transaction['transactionId'], account_id,
-                                       get_ticker_id(con, cursor, transaction['transactionItem']['instrument']['symbol']),
-                                       int((dateutil.parser.parse(transaction['transactionDate'])).timestamp()),
-                                       transaction['transactionItem']['amount'], 0.0,
-                                       transaction['netAmount'], transaction['description']))
-
-        # Buy or Sell
-        elif (transaction['type'] == 'TRADE'):
-            # Add the symbol if it doesn't already exist
-            insert_ticker(con, cursor, transaction['transactionItem']['instrument']['symbol'])
-            insertion_data.append((transaction['transactionId'], account_id,
-                                   get_ticker_id(con, cursor, transaction['transactionItem']['instrument']['symbol']),
-                                   int((dateutil.parser.parse(transaction['transactionDate'])).timestamp()),
-                                   transaction['transactionItem']['amount'], transaction['transactionItem']['price'],
-                                   transaction['netAmount'], transaction['description']))
-
+        if (transaction['type'] in ('DIVIDEND_OR_INTEREST', 'TRADE')):
+            wanted_symbols.add(_transaction_symbol(transaction))
+    new_symbols = wanted_symbols - _ticker_cache.keys()
+    if (new_symbols):
+        cursor.executemany("INSERT OR IGNORE INTO Tickers (Ticker) VALUES (?);",
+                           [(symbol,) for symbol in new_symbols])
+        cursor.execute("SELECT Ticker, Id FROM Tickers;")
+        _ticker_cache.update(cursor.fetchall())
+
+    # Stream the rows into executemany through a generator instead of
+    # materializing the whole batch first -- sqlite pulls one row at a time,
+    # so a multi-year backfill never holds every tuple in memory at once.
+    # The ticker ids are collected along the way for the return value. The
+    # generator runs while executemany is consuming it, so any cache-miss
+    # lookups it makes need their own cursor
+    inserted_tickers = set()
+    lookup_cursor = con.cursor()
+
+    def transaction_rows():
+        for transaction in transactions:
+
+            if ('transactionId' not in transaction):
+                logger.warning("Ignored a transaction without a transaction ID. These usually get added by TD later and will be automatically imported")
+                continue
+
+            logger.debug("Working on transactions id %s of type %s", transaction['transactionId'], transaction['type'])
+
+            # ... but only after we ignore certain types
+            if (transaction['type'] in IGNORED_TRANSACTIONS):
+                logger.warning("Ignoring transaction id %s of type %s", transaction['transactionId'], transaction['type'])
+                continue
+
+            # And we validate that we're not inserting a duplicate
+            if (transaction['transactionId'] in existing_transactions):
+                logger.warning("Ignoring transaction id %s because it already exists in the DB", transaction['transactionId'])
+                continue
+
+            # And we're scared of the unknown
+            assert (transaction['type'] in KNOWN_TRANSACTIONS), "Encountered unknown type of transaction '{0}' in transaction id {1}".format(transaction['type'], transaction['transactionId'])
+            if (transaction['type'] != 'ELECTRONIC_FUND' and transaction['description'] != 'FREE BALANCE INTEREST ADJUSTMENT'):
+                assert (transaction['transactionItem']['instrument']['assetType'] in KNOWN_ASSET_TYPES), "Encountered unknown asset type '{0}' in transaction id {1}".format(transaction['transactionItem']['instrument']['assetType'], transaction['transactionId'])
+
+            # Yield the transaction for insertion. The per-type tuple
+            # construction lives in the module-level _ROW_BUILDERS table, so
+            # the row loop just resolves the symbol, epoch, and ticker id
+            # once and dispatches
+            ticker_id = get_ticker_id(con, lookup_cursor, _transaction_symbol(transaction))
+            inserted_tickers.add(ticker_id)
+            yield _ROW_BUILDERS[transaction['type']](
+                transaction, account_id, ticker_id,
+                _to_epoch(transaction['transactionDate']))
 
     # Insert the transactions into the DB
+    # One executemany call so the statement is compiled once, and no commit
+    # here -- the caller owns the transaction
     insertion = ("INSERT INTO Transactions (Id, AccountId, TickerId, Date, Quantity, Price, Total, Description) "
                  "VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
-    cursor.executemany(insertion, insertion_data)
-    con.commit()
+    cursor.executemany(insertion, transaction_rows())
+    if (own_transaction):
+        con.commit()
 
-    return insertion_data
+    return inserted_tickers
@@ -7,9 +7,9 @@
 #############
 ## Imports ##
 #############
+import concurrent.futures
 import datetime
 import dateutil
-import json
 import logging
 import os
 import requests
@@ -18,22 +18,60 @@ import tda
 import time
 
 
+#############################
+## Import Custom Libraries ##
+#############################
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import utility
+
+# logging.getLogger() takes a lock on every call, so grab the logger once
+# at import time instead of at the top of every method
+logger = logging.getLogger(__name__)
+
+# The orjson/ujson/stdlib response parsing shim lives in utility so
+# telegram.py can share it
+_parse_response = utility.parse_response
+
+# pysimdjson decodes the multi-megabyte transaction payloads with SIMD
+# instructions. We deliberately materialize with loads rather than using
+# the lazy document API: the year windows are parsed on worker threads and
+# their results outlive later parses, which would invalidate lazy simdjson
+# documents backed by a shared parser
+try:
+    import simdjson
+
+    def _parse_transactions(response):
+        return simdjson.loads(response.content)
+except ImportError:
+    _parse_transactions = _parse_response
+
+
 ###############
 ## Functions ##
 ###############
-def _refresh_auth_code(token_path, api_key, tel=None):
+def _refresh_auth_code(token_path, api_key, tel=None, session=None, force=False):
     """
     Purpose: Refreshes the OAuth token. This must be outside of the class
              definition otherwise name mangling occurs
     @param token_path (str) - the path to the OAuth token on disk
     @param api_key (str) - the TDAmeritrade API key
     @param tel (Telegram) - a Telegram object used to send messages
+    @param session (requests.Session) - a pooled session to reuse for the
+           request. If unspecified, a one-off connection is made
+    @param force (bool) - refresh even if the token isn't near expiry
     @return (None) - nothing. Updates the token on disk
     """
 
     # Load the data from the token file
     token_data = tda.auth.__token_loader(token_path)()
 
+    # If the token on disk still has more than five minutes of life, skip
+    # the refresh entirely -- the POST costs a full round trip on every
+    # process start otherwise
+    if (not force and token_data.get('expires_at', 0) - int(time.time()) > 300):
+        logger.debug("OAuth token is not near expiry. Skipping the refresh")
+        return None
+
     # Build the HTTP body
     body = {
         'grant_type':    'refresh_token',
@@ -44,7 +82,7 @@ def _refresh_auth_code(token_path, api_key, tel=None):
     # Make the request
     try:
         uri = 'https://api.tdameritrade.com/v1/oauth2/token'
-        response = requests.post(uri, data=body)
+        response = (session or requests).post(uri, data=body)
         assert response.ok, "Encountered an error while attempting to refresh the OAuth token. \nStatus code: {0}\nError message: {1}".format(response.status_code, response.text)
     except Exception as e:
         if (tel):
@@ -53,7 +91,7 @@ def _refresh_auth_code(token_path, api_key, tel=None):
             raise e
 
     # Update fields in the token file and write it back out to disk
-    new_token_data = json.loads(response.text)
+    new_token_data = _parse_response(response)
     epoch_time = int(time.time())
     token_data['access_token'] = new_token_data['access_token']
     token_data['scope']        = new_token_data['scope']
@@ -63,6 +101,34 @@ def _refresh_auth_code(token_path, api_key, tel=None):
     tda.auth.__update_token(token_path)(token_data)
 
 
+def _build_market_buy_order(ticker, count):
+    """
+    Purpose: Builds the body of a market buy order for the TD API. Building
+             the dict directly skips the old format-then-json.loads round
+             trip, since the client just re-serializes it anyway
+    @param ticker (str) - the stock symbol to buy
+    @param count (int) - the quantity of stocks to buy
+    @return (dict) - the order, ready to hand to the tda client
+    """
+
+    return {
+        'orderType':         'MARKET',
+        'session':           'NORMAL',
+        'duration':          'DAY',
+        'orderStrategyType': 'SINGLE',
+        'orderLegCollection': [
+            {
+                'instruction': 'Buy',
+                'quantity':    int(count),
+                'instrument': {
+                    'symbol':    ticker,
+                    'assetType': 'EQUITY'
+                }
+            }
+        ]
+    }
+
+
 #############
 ## Classes ##
 #############
@@ -90,19 +156,33 @@ class TDApi:
         with open(os.path.expanduser(api_key_path), 'r') as f:
             self.__api_key = f.read()
 
+        # One pooled session for everything we send to TD. Keep-alive reuse
+        # saves a fresh TCP + TLS handshake (about a round trip) per call,
+        # which dominates for these small API requests
+        self._session = requests.Session()
+        self._session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+        # Short-lived cache of parsed get_account responses, so callers
+        # that ask for several figures back to back share one round trip
+        self.__account_cache = {}
+
         # Set up the OAuth token
         self.refresh_auth_code()
 
 
-    def refresh_auth_code(self):
+    def refresh_auth_code(self, force=False):
         """
         Purpose: Updates the OAuth token
+        @param force (bool) - refresh even if the token isn't near expiry
         """
-        # Refresh the authorization token
-        _refresh_auth_code(self.__token_path, self.__api_key, self.__tel)
+        # Refresh the authorization token (a no-op if it's not needed)
+        _refresh_auth_code(self.__token_path, self.__api_key, self.__tel, session=self._session, force=force)
 
-        # Set the client object
+        # Set the client object. tda.auth builds its own OAuth session
+        # internally, so mount a pooled adapter on it too -- every API call
+        # the client makes then reuses keep-alive connections as well
         self._client = tda.auth.client_from_token_file(self.__token_path, self.__api_key)
+        self._client.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
 
 
     def __catch_error(self, e, error_message):
@@ -115,8 +195,6 @@ class TDApi:
         @return (None) - this function either ends with exit() or raises an error
         """
 
-        # Set up logging to log the error
-        logger = logging.getLogger()
         logger.error(error_message)
 
         # Send the error notification or fail
@@ -128,6 +206,31 @@ class TDApi:
             raise e
 
 
+    def __get_account(self, account_id, fields=None):
+        """
+        Purpose: Fetches the parsed account JSON, reusing a response less
+                 than a second old. get_liquidation_value followed by
+                 get_cash_balance returns identical JSON twice, so the
+                 memoization collapses those into one network call
+        @param self (Object) - instance of the current class
+        @param account_id (str) - the ID of the TD Ameritrade account to use
+        @param fields (Object) - extra fields to request (e.g. positions)
+        @return (dict) - the parsed account JSON
+        """
+
+        cache_key = (account_id, fields)
+        cached = self.__account_cache.get(cache_key)
+        if (cached and time.time() - cached[0] < 1.0):
+            logger.debug("Reusing the cached account data for account ID %s", account_id)
+            return cached[1]
+
+        response = self._client.get_account(account_id, fields=fields)
+        assert response.status_code == 200, "Response from TD API was status code {0}".format(response.status_code)
+        account = _parse_response(response)
+        self.__account_cache[cache_key] = (time.time(), account)
+        return account
+
+
     def get_accounts(self):
         """
         Purpose: Gets the accounts available via the API and the
@@ -135,8 +238,6 @@ class TDApi:
         @return (list) - a list of dictionaries containing account_id, liquidation, and cash values
         """
         
-        # Set up debugging for the function
-        logger = logging.getLogger()
         logger.debug("Entering get_accounts")
 
         # Get the accounts
@@ -149,10 +250,14 @@ class TDApi:
         # Perform validation to make sure everything is as expected in the json
         try:
             accounts = []
-            for account in response.json():
-                accounts.append( { 'account_id' : account['securitiesAccount']['accountId'],
-                                   'liquidation_value' : account['securitiesAccount']['currentBalances']['liquidationValue'],
-                                   'cash_value' : account['securitiesAccount']['currentBalances']['cashBalance'] })
+            for account in _parse_response(response):
+                # Bind the nested objects once instead of re-walking the
+                # securitiesAccount -> currentBalances chain for every field
+                securities_account = account['securitiesAccount']
+                balances = securities_account['currentBalances']
+                accounts.append( { 'account_id' : securities_account['accountId'],
+                                   'liquidation_value' : balances['liquidationValue'],
+                                   'cash_value' : balances['cashBalance'] })
         except Exception as e:
             self.__catch_error(e, "Unexpected error while parsing the JSON returned by the API: {0}".format(repr(e)))
 
@@ -161,35 +266,55 @@ class TDApi:
         return accounts
 
 
-    def get_liquidation_value(self, account_id):
+    def get_account_snapshot(self, account_id):
         """
-        Purpose: Gets the liquidation value of the specified account
-        @param self (Object) - instance of current class
+        Purpose: Gets the balances and positions of an account in one API
+                 call. The positions response already carries the balance
+                 fields, so a caller that wants the full picture shouldn't
+                 pay three round trips for it
+        @param self (Object) - an instance of the current class
         @param account_id (str) - the ID of the TD Ameritrade account to use
-        @return (float) - the liquidation value of the specified account
+        @return (dict) - the liquidation_value, cash_value, cash_available,
+                and positions of the account
         """
-        
-        # Set up debugging for the function
-        logger = logging.getLogger()
-        logger.debug("Entering get_liquidation_value. Parameters are:\n\taccount_id: {0}".format(account_id))
 
-        # Get the account balance
+        logger.debug("Entering get_account_snapshot. Parameters are:\n\taccount_id: %s", account_id)
+
+        # Get the account, positions included
         try:
-            response = self._client.get_account(account_id)
-            assert response.status_code == 200, "Response from TD API was status code {0}".format(response.status_code)
+            account = self.__get_account(account_id, fields=self._client.Account.Fields.POSITIONS)
         except Exception as e:
-            self.__catch_error(e, "Error retrieving total account balance. Error: '{0}'".format(repr(e)))
+            self.__catch_error(e, "Error retrieving the account snapshot. Error: '{0}'".format(repr(e)))
 
         # Perform validation to make sure everything is as expected in the json
         try:
-            account = response.json()
-            assert account['securitiesAccount']['currentBalances']['liquidationValue'], "JSON returned from API doesn't contain the liquidation value"
-            total_value = account['securitiesAccount']['currentBalances']['liquidationValue']
+            securities_account = account['securitiesAccount']
+            balances = securities_account['currentBalances']
+            snapshot = { 'liquidation_value' : balances['liquidationValue'],
+                         'cash_value' : balances['cashBalance'],
+                         'cash_available' : balances['cashAvailableForTrading'],
+                         'positions' : securities_account.get('positions', []) }
         except Exception as e:
             self.__catch_error(e, "Unexpected error while parsing the JSON returned by the API: {0}".format(repr(e)))
 
-        # Return the balance
-        logger.debug("Account has total balance of ${0}".format(total_value))
+        logger.debug("Successfully retrieved the snapshot for account ID %s", account_id)
+        return snapshot
+
+
+    def get_liquidation_value(self, account_id):
+        """
+        Purpose: Gets the liquidation value of the specified account
+        @param self (Object) - instance of current class
+        @param account_id (str) - the ID of the TD Ameritrade account to use
+        @return (float) - the liquidation value of the specified account
+        """
+
+        logger.debug("Entering get_liquidation_value. Parameters are:\n\taccount_id: %s", account_id)
+
+        # The snapshot (and the cache behind it) means mixed balance and
+        # position calls for the same account share one round trip
+        total_value = self.get_account_snapshot(account_id)['liquidation_value']
+        logger.debug("Account has total balance of $%s", total_value)
         return total_value
 
 
@@ -201,31 +326,14 @@ class TDApi:
         @return (float) - the current amount of unused cash in the specified account
         """
 
-        # Set up debugging for the function
-        logger = logging.getLogger()
-        logger.debug("Entering get_cash_balance. Parameters are:\n\taccount_id: {0}".format(account_id))
+        logger.debug("Entering get_cash_balance. Parameters are:\n\taccount_id: %s", account_id)
 
-        # Get the account balance
-        try:
-            response = self._client.get_account(account_id)
-            assert response.status_code == 200, "Response from TD API was status code {0}".format(response.status_code)
-        except Exception as e:
-            self.__catch_error(e, "Error retrieving account balance. Error: '{0}'".format(repr(e)))
-
-        # Perform validation to make sure everything is as expected in the json
-        try:
-            account = response.json()
-            assert account['securitiesAccount']['currentBalances']['cashAvailableForTrading'], "JSON returned from API doesn't contain the expected properties"
-            cash_balance = account['securitiesAccount']['currentBalances']['cashAvailableForTrading']
-        except Exception as e:
-            self.__catch_error(e, "Unexpected error while parsing the JSON returned by the API: {0}".format(repr(e)))
-
-        # Return the balance
-        logger.debug("Account has cash balance of ${0}".format(cash_balance))
+        cash_balance = self.get_account_snapshot(account_id)['cash_available']
+        logger.debug("Account has cash balance of $%s", cash_balance)
         return cash_balance
 
 
-    def get_price_history(self, ticker, start_date=(datetime.datetime.now() + datetime.timedelta(days=-31)), end_date=None):
+    def get_price_history(self, ticker, start_date=None, end_date=None):
         """
         Purpose: Gets the candle price history of a particular stock for the past month
         @param self (Object) - an instance of the current class
@@ -236,9 +344,13 @@ class TDApi:
                          high, and low prices of the ticker for a given day
         """
 
-        # Set up debugging for the function
-        logger = logging.getLogger()
-        logger.debug("Entering get_price_history. Parameters are:\n\tticker: {0}\n\tstart_date: {1}\n\tend_date: {2}".format(ticker, start_date, end_date))
+        logger.debug("Entering get_price_history. Parameters are:\n\tticker: %s\n\tstart_date: %s\n\tend_date: %s", ticker, start_date, end_date)
+
+        # The 31-day default is computed here rather than in the signature;
+        # a default in the def line is evaluated once at import, so it goes
+        # stale in any long-lived process
+        if (start_date is None):
+            start_date = datetime.datetime.now() + datetime.timedelta(days=-31)
 
         # Initialize the variables for the API call
         frequency_type = self._client.PriceHistory.FrequencyType.DAILY
@@ -258,8 +370,30 @@ class TDApi:
         except Exception as e:
             self.__catch_error(e, "Error retrieving the price history. Error: '{0}'".format(repr(e)))
 
-        logger.debug("Successfully retrieved price history for '{0}'".format(ticker))
-        return response.json()['candles']
+        logger.debug("Successfully retrieved price history for '%s'", ticker)
+        return _parse_response(response)['candles']
+
+
+    def get_price_histories(self, tickers, start_date=None, end_date=None):
+        """
+        Purpose: Gets the candle price history for several stocks at once.
+                 The calls are network-bound and independent, so they're
+                 fanned out over a thread pool -- the pooled session keeps
+                 the TLS connections warm across the worker threads
+        @param self (Object) - an instance of the current class
+        @param tickers (iterable) - the ticker symbols to get history for
+        @param start_date (datetime) - the beginning date to get prices for. Defaults to 30 days ago
+        @param end_date (datetime) - the end date to get prices for. Defaults to last trading day
+        @return (dict) - maps each ticker symbol to its list of candles
+        """
+
+        logger.debug("Entering get_price_histories. Parameters are:\n\ttickers: %s\n\tstart_date: %s\n\tend_date: %s", tickers, start_date, end_date)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            fetches = [(ticker, executor.submit(self.get_price_history, ticker,
+                                                start_date=start_date, end_date=end_date))
+                       for ticker in tickers]
+            return {ticker: fetch.result() for (ticker, fetch) in fetches}
 
 
     def get_account_positions(self, account_id):
@@ -273,27 +407,17 @@ class TDApi:
                  about a particular stock
         """
         
-        # Set up debugging for the function
-        logger = logging.getLogger()
         logger.debug("Entering get_account_positions")
 
         # Get the contents of the portfolio
         try:
-            response = self._client.get_account(account_id, fields=self._client.Account.Fields.POSITIONS)
-            assert response.status_code == 200, "Response from TD API was status code {0}".format(response.status_code)
+            positions = self.get_account_snapshot(account_id)['positions']
+            assert positions, "JSON returned from API doesn't contain the positions"
         except Exception as e:
             self.__catch_error(e, "Error retrieving the account positions. Error: '{0}'".format(repr(e)))
 
-        # Perform validation to make sure everything is as expected in the json
-        try:
-            response = response.json()
-            assert response['securitiesAccount']['positions'], "JSON returned from API doesn't contain the positions"
-            positions = response['securitiesAccount']['positions']
-        except Exception as e:
-            self.__catch_error(e, "Unexpected error while parsing the JSON returned by the API: {0}".format(repr(e)))
-
         # Return the positions
-        logger.debug("Retrieved the positions for account ID {0}".format(account_id))
+        logger.debug("Retrieved the positions for account ID %s", account_id)
         return positions
 
 
@@ -305,9 +429,7 @@ class TDApi:
         @return (I don't remember) Returns [] when there are no saved orders
         """
 
-        # Set up debugging for the function
-        logger = logging.getLogger()
-        logger.debug("Entering get_saved_orders. Parameters are:\n\taccount_id: {0}".format(account_id))
+        logger.debug("Entering get_saved_orders. Parameters are:\n\taccount_id: %s", account_id)
 
         # Get the saved orders
         try:
@@ -317,7 +439,7 @@ class TDApi:
             self.__catch_error(e, "Error getting saved orders from TD ameritrade: '{0}'".format(repr(e)))
 
         logger.debug("Retrieved saved orders")
-        return json.loads(response.text)
+        return _parse_response(response)
 
 
     def remove_saved_order(self, account_id, order_id):
@@ -329,9 +451,7 @@ class TDApi:
         @return (None) - nothing
         """
 
-        # Set up debugging for the function
-        logger = logging.getLogger()
-        logger.debug("Entering remove_saved_order. Parameters are:\n\taccount_id: {0}\n\torder_id: {1}".format(account_id, order_id))
+        logger.debug("Entering remove_saved_order. Parameters are:\n\taccount_id: %s\n\torder_id: %s", account_id, order_id)
 
         # Delete the saved order
         try:
@@ -356,30 +476,11 @@ class TDApi:
         @return (None) - nothing
         """
 
-        # Set up debugging for the function
-        logger = logging.getLogger()
-        logger.debug("Entering new_saved_order. Parameters are:\n\taccount_id: {0}\n\tticker: {1}\n\tcount: {2}".format(account_id,ticker, count))
+        logger.debug("Entering new_saved_order. Parameters are:\n\taccount_id: %s\n\tticker: %s\n\tcount: %s", account_id,ticker, count)
 
         # Create the order
-        order = json.loads("""
-    {{
-        "orderType":         "MARKET",
-        "session":           "NORMAL",
-        "duration":          "DAY",
-        "orderStrategyType": "SINGLE",
-        "orderLegCollection": [
-            {{
-                "instruction": "Buy",
-                "quantity":    {0},
-                "instrument":
-                    {{
-                        "symbol":    "{1}",
-                        "assetType": "EQUITY"
-                    }}
-            }}
-        ]
-    }}""".format(str(count), ticker))
-        logger.debug("Order: {0}".format(order))
+        order = _build_market_buy_order(ticker, count)
+        logger.debug("Order: %s", order)
 
         # Save the order
         try:
@@ -404,35 +505,16 @@ class TDApi:
         @return (None) - nothing
         """
 
-        # Set up debugging for the function
-        logger = logging.getLogger()
-        logger.debug("Entering send_order. Parameters are:\n\taccount_id: {0}\n\tticker: {1}\n\tcount: {2}".format(account_id, ticker, count))
+        logger.debug("Entering send_order. Parameters are:\n\taccount_id: %s\n\tticker: %s\n\tcount: %s", account_id, ticker, count)
 
         # Create the order
-        order = json.loads("""
-    {{
-        "orderType":         "MARKET",
-        "session":           "NORMAL",
-        "duration":          "DAY",
-        "orderStrategyType": "SINGLE",
-        "orderLegCollection": [
-            {{
-                "instruction": "Buy",
-                "quantity":    {0},
-                "instrument":
-                    {{
-                        "symbol":    "{1}",
-                        "assetType": "EQUITY"
-                    }}
-            }}
-        ]
-    }}""".format(str(count), ticker))
-        logger.debug("Order: {0}".format(order))
+        order = _build_market_buy_order(ticker, count)
+        logger.debug("Order: %s", order)
 
         # Execute the order
         try:
             response = self._client.place_order(account_id, order)
-            assert (response.status_code == 200 or response.status_code == 201), "Response from TD API was status code {0}".format(response.status_code)
+            assert (response.status_code in (200, 201)), "Response from TD API was status code {0}".format(response.status_code)
         except Exception as e:
             self.__catch_error(e, "Error sending order to TD ameritrade: '{0}'".format(repr(e)))
 
@@ -456,9 +538,7 @@ class TDApi:
         # way to verify if it's all transactions or just all transactions from the
         # past year as my account hasn't been open for more than a year yet
 
-        # Set up debugging for the function
-        logger = logging.getLogger()
-        logger.debug("Entering get_transactions. Parameters are:\n\taccount_id: {0}\n\tsymbol: {1}\n\tstart_date: {2}\n\tend_date: {3}".format(account_id, symbol, start_date, end_date))
+        logger.debug("Entering get_transactions. Parameters are:\n\taccount_id: %s\n\tsymbol: %s\n\tstart_date: %s\n\tend_date: %s", account_id, symbol, start_date, end_date)
 
         # Double check the parameters
         assert ((start_date and end_date) or (not start_date and not end_date)), "Both start_date and end_date must be specified"
@@ -470,24 +550,33 @@ class TDApi:
         result = []
         try:
             if (start_date):  # A range was specified
-                while (start_date < end_date):
 
-                    # Calculate the end date
+                # Split the span into 365-day windows up front
+                windows = []
+                while (start_date < end_date):
                     effective_end_date = (start_date + datetime.timedelta(days=365)) if ((end_date - start_date).days > 365) else end_date
-                    logger.debug("Getting transactions from {0} to {1}".format(start_date, effective_end_date))
-
-                    # Call the TD API and validate the response
-                    response = self._client.get_transactions(account_id, symbol=symbol, start_date=start_date, end_date=effective_end_date)
-                    assert (response.status_code == 200 or response.status_code == 201), "Response from TD API was status code {0}".format(response.status_code)
-                    result += response.json()
-
-                    # Update the start date for the next iteration
+                    windows.append((start_date, effective_end_date))
                     start_date = effective_end_date
 
+                # Each window is an independent network-bound call, so fan
+                # them out over a thread pool instead of waiting for each
+                # round trip before starting the next. executor.map returns
+                # the results in window order, so the concatenation matches
+                # what the old serial loop produced
+                def fetch_window(window):
+                    logger.debug("Getting transactions from %s to %s", window[0], window[1])
+                    response = self._client.get_transactions(account_id, symbol=symbol, start_date=window[0], end_date=window[1])
+                    assert (response.status_code in (200, 201)), "Response from TD API was status code {0}".format(response.status_code)
+                    return _parse_transactions(response)
+
+                with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+                    for window_result in executor.map(fetch_window, windows):
+                        result += window_result
+
             else:  # no range was specified
                     response = self._client.get_transactions(account_id, symbol=symbol)
-                    assert (response.status_code == 200 or response.status_code == 201), "Response from TD API was status code {0}".format(response.status_code)
-                    result = response.json()
+                    assert (response.status_code in (200, 201)), "Response from TD API was status code {0}".format(response.status_code)
+                    result = _parse_transactions(response)
 
         except Exception as e:
             self.__catch_error(e, "Error sending order to TD ameritrade: '{0}'".format(repr(e)))
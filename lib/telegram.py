@@ -7,13 +7,28 @@
 #############
 ## Imports ##
 #############
-import json
 import logging
+import os
 import requests
 import socket
 import sys
 
 
+#############################
+## Import Custom Libraries ##
+#############################
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import utility
+
+
+######################
+## Static Variables ##
+######################
+# logging.getLogger() takes a lock on every call, so grab the logger once
+# at import time instead of at the top of every method
+logger = logging.getLogger(__name__)
+
+
 #############
 ## Classes ##
 #############
@@ -30,36 +45,46 @@ class Telegram:
         self.base_uri = base_uri + 'bot{0}/'.format(bot_id)
         self.chat_id = chat_id
 
+        # One pooled session for all the telegram requests, so repeated
+        # messages reuse the same TCP + TLS connection instead of paying
+        # for a new handshake each time
+        self._session = requests.Session()
+
+        # Endpoint URIs are built once and reused across requests
+        self.__endpoint_uris = {}
 
-    def __send_request(self, endpoint, method, body={}, error_message='Error interacting with the telegram API'):
+
+    def __send_request(self, endpoint, method, body=None, error_message='Error interacting with the telegram API'):
         """
         Purpose: Sends the HTTP request to the telegram API
         @param   self (Object) - reference to the current instance of the class
         @param   endpoint (String) - the API function to use
         @param   method (String) - the HTTP method to use for the endpoint
-        @param   body (dict) - the body of the request in JSON (dict) format
+        @param   body (dict) - the body of the request in JSON (dict) format.
+                 The caller's dict is copied, not modified
         @param   error_message (String) - the message to log if the request fails
         @return  (dict) - the JSON returned from the API
         """
-        
-        # Set up debugging for the function
-        logger = logging.getLogger()
-        logger.debug('Entering send_request. Parameters are:\n\tendpoint: {0}\n\tmethod: {1}\n\tbody: {2}\n\terror_message: {3}'.format(endpoint, method, body, error_message))
 
-        # Set the URI and add the chat ID to the body
-        uri = '{0}{1}'.format(self.base_uri, endpoint)
+        logger.debug('Entering send_request. Parameters are:\n\tendpoint: %s\n\tmethod: %s\n\tbody: %s\n\terror_message: %s', endpoint, method, body, error_message)
+
+        # Reuse the endpoint URI if we've built it before. Copy the body
+        # before adding the chat ID -- the old shared default dict meant
+        # one call's chat_id quietly leaked into the next
+        uri = self.__endpoint_uris.setdefault(endpoint, self.base_uri + endpoint)
+        body = dict(body) if (body) else {}
         body['chat_id'] = self.chat_id
 
         # Only two methods allowed: GET and POST
         assert (method == 'GET' or method == 'POST'), "Error, method must be either 'GET' or 'POST'"
         try:
             if (method == 'GET'):
-                response = requests.get(uri)
+                response = self._session.get(uri)
             else:
-                response = requests.post(uri, body)
+                response = self._session.post(uri, body)
             assert response.ok, 'Response from the telegram API was status code {0}'.format(response.status_code)
         except Exception as e:
-            logger.error('{0}. Error: {1}'.format(error_message, repr(e)))
+            logger.error('%s. Error: %s', error_message, repr(e))
             response = None
 
         return response
@@ -75,9 +100,6 @@ class Telegram:
         @param   message (string) - the error message
         @return  None
         """
-        
-        # Set up debugging for the function
-        logger = logging.getLogger()
 
         # Log the error, notify the user, and exit
         logger.error(message)
@@ -95,13 +117,11 @@ class Telegram:
                  successfully sent or None if the server doesn't respond with 200
         """
         
-        # Set up debugging for the function
-        logger = logging.getLogger()
-        logger.debug("Entering send_message. Parameters are:\n\tmessage: {0}".format(message))
+        logger.debug("Entering send_message. Parameters are:\n\tmessage: %s", message)
         
         # Send the message
         response = self.__send_request('sendMessage', 'POST', body={'text': message})
-        return json.loads(response.text)
+        return utility.parse_response(response)
 
 
     def get_pinned_message(self):
@@ -111,8 +131,6 @@ class Telegram:
         @return  (dict) - the JSON response from the telegram API. This is a message object
         """
 
-        # Set up debugging for the function
-        logger = logging.getLogger()
         logger.debug("Entering get_pinned_message")
 
         # Get the chat object
@@ -120,9 +138,9 @@ class Telegram:
 
         # Return the pinned message
         try:
-            pinned_message = json.loads(response.text)['result']['pinned_message']
+            pinned_message = utility.parse_response(response)['result']['pinned_message']
         except KeyError:
-            logger.warning("JSON response doesn't contain a pinned message. JSON: {0}".format(response.text))
+            logger.warning("JSON response doesn't contain a pinned message. JSON: %s", response.text)
             pinned_message = None
 
         return pinned_message
@@ -136,9 +154,7 @@ class Telegram:
         @return  (NoneType) - nada
         """
 
-        # Set up debugging for the function
-        logger = logging.getLogger()
-        logger.debug('Entering pin_message. Parameters are:\n\tmessage_id: {0}'.format(message_id))
+        logger.debug('Entering pin_message. Parameters are:\n\tmessage_id: %s', message_id)
 
         # Pin the message in the chat
         body = {
@@ -157,13 +173,11 @@ class Telegram:
         @return  (dict) - JSON response of updates
         """
         
-        # Set up debugging for the function
-        logger = logging.getLogger()
         logger.debug('Entering get_updates')
         
         # Get all the new updates
         response = self.__send_request('getUpdates', 'GET')
-        return json.loads(response.text)
+        return utility.parse_response(response)
 
 
     def unpin_all_chat_messages(self):
@@ -173,8 +187,6 @@ class Telegram:
         @return  (NoneType) - nada
         """
 
-        # Set up debugging for the function
-        logger = logging.getLogger()
         logger.debug('Entering unpin_all_chat_messages')
 
         # Unpin all the messages
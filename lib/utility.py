@@ -7,6 +7,36 @@
 ## Imports ##
 #############
 import datetime
+import numpy
+
+# orjson parses large JSON payloads several times faster than the stdlib
+# json module (and takes bytes directly, skipping a UTF-8 decode), with
+# ujson as a decent middle ground. Fall back gracefully if neither is
+# installed
+try:
+    import orjson
+
+    def parse_response(response):
+        """Parses the JSON body of a requests response"""
+        return orjson.loads(response.content)
+except ImportError:
+    try:
+        import ujson
+
+        def parse_response(response):
+            """Parses the JSON body of a requests response"""
+            return ujson.loads(response.content)
+    except ImportError:
+        def parse_response(response):
+            """Parses the JSON body of a requests response"""
+            return response.json()
+
+
+# from_epoch is called once per candle/transaction downstream, so bind the
+# method once at import instead of walking datetime.datetime.fromtimestamp
+# (two attribute lookups) on every call
+_fromtimestamp = datetime.datetime.fromtimestamp
+
 
 ###############
 ## Functions ##
@@ -18,4 +48,62 @@ def from_epoch(epoch):
     @return (datetime) - the time represented by the epoch time, but
             actually readable
     """
-    return datetime.datetime.fromtimestamp(epoch)
+    return _fromtimestamp(epoch)
+
+
+def from_epoch_array(epochs_ms):
+    """
+    Purpose: Converts a whole batch of millisecond epoch times at once.
+             Calling from_epoch in a Python loop pays interpreter overhead
+             per row; the numpy conversion is effectively free per element
+    @param epochs_ms (iterable) - epoch times in milliseconds
+    @return (ndarray) - the times as datetime64[ms] values
+    """
+    return numpy.asarray(epochs_ms, dtype=numpy.int64).astype('datetime64[ms]')
+
+
+def lttb_downsample(x, y, n_out):
+    """
+    Purpose: Downsamples a series to at most n_out points with the
+             Largest-Triangle-Three-Buckets algorithm, which keeps the points
+             that contribute most to the visual shape of the line
+    @param x (ndarray) - the x values in ascending order
+    @param y (ndarray) - the y values
+    @param n_out (int) - the maximum number of points to keep (at least 3)
+    @return (ndarray) - ascending indices of the points to keep, so callers
+            can subset any parallel columns with the same selection
+    """
+
+    length = len(x)
+    if (n_out >= length or n_out < 3):
+        return numpy.arange(length)
+
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+
+    # The first and last points are always kept; everything in between is
+    # split into n_out - 2 buckets
+    edges = numpy.linspace(1, length - 1, n_out - 1).astype(numpy.int64)
+    selected = numpy.empty(n_out, dtype=numpy.int64)
+    selected[0] = 0
+    selected[-1] = length - 1
+
+    previous = 0
+    for i in range(n_out - 2):
+        low = edges[i]
+        high = max(edges[i + 1], low + 1)
+
+        # Average of the next bucket (or the final point for the last bucket)
+        next_low = high
+        next_high = max(edges[i + 2] if (i + 2 < len(edges)) else length, next_low + 1)
+        average_x = x[next_low:next_high].mean()
+        average_y = y[next_low:next_high].mean()
+
+        # Keep the point forming the largest triangle with the previously
+        # selected point and the next bucket's average
+        area = numpy.abs((x[previous] - average_x) * (y[low:high] - y[previous]) -
+                         (x[previous] - x[low:high]) * (average_y - y[previous]))
+        previous = low + int(numpy.argmax(area))
+        selected[i + 1] = previous
+
+    return selected